@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Measure the cold start of the app, each run in a fresh interpreter.
+
+    python benchmarks/startup.py --runs 10
+
+Reports the time to import the package and run ``create_app``, and fails if torch or
+transformers got imported along the way, they belong to the worker processes.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+HEAVY_MODULES = ('torch', 'transformers')
+
+PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+from moments import create_app
+app = create_app('testing')
+import moments.ml_services
+moments.ml_services.MLImageAnalyzer()
+print(json.dumps({{
+    'seconds': time.perf_counter() - start,
+    'heavy': [name for name in {HEAVY_MODULES!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure(runs):
+    root = Path(__file__).resolve().parent.parent
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE], cwd=root, capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters, default is 5.')
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+    seconds = [result['seconds'] for result in results]
+    print(f'create_app: min {min(seconds):.3f}s, median {statistics.median(seconds):.3f}s over {args.runs} runs')
+    heavy = sorted({name for result in results for name in result['heavy']})
+    if heavy:
+        print(f'Heavy ML modules imported at startup: {", ".join(heavy)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
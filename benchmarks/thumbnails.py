@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Compare the CPU time of creating the upload thumbnails, one decode per size against one decode in total.
+
+    python benchmarks/thumbnails.py [IMAGE ...] --runs 5
+
+Without images, a few synthetic JPEG and PNG files of camera-like sizes are generated.
+"""
+
+import argparse
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image, ImageFilter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from moments.settings import BaseConfig  # noqa: E402
+from moments.utils import create_thumbnails, thumbnail_suffixes  # noqa: E402
+
+
+def resize_image_per_size(path, filename, base_width, upload_path, suffixes):
+    """The previous pipeline: a full decode and a resize from full resolution for every size."""
+    img = Image.open(path)
+    if img.size[0] <= base_width:
+        return filename
+    h_size = int(img.size[1] * base_width / img.size[0])
+    img = img.resize((base_width, h_size), Image.LANCZOS)
+    filename += suffixes[base_width] + Path(filename).suffix
+    img.save(upload_path / filename, optimize=True, quality=85)
+    return filename
+
+
+def sample_images(directory):
+    paths = []
+    for size, ext in [((4032, 3024), '.jpg'), ((6000, 4000), '.jpg'), ((1920, 1080), '.jpg'), ((2048, 1536), '.png')]:
+        # some texture so the encoders have real work to do
+        image = Image.effect_noise(size, 64).convert('RGB').filter(ImageFilter.GaussianBlur(2))
+        path = Path(directory) / f'sample_{size[0]}x{size[1]}{ext}'
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def cpu_time(func, runs):
+    times = []
+    for _ in range(runs):
+        start = time.process_time()
+        func()
+        times.append(time.process_time() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('images', nargs='*', type=Path, help='Images to resize, default is synthetic samples.')
+    parser.add_argument('--runs', type=int, default=5, help='Runs per image, the median is reported, default is 5.')
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp())
+    suffixes = thumbnail_suffixes(vars(BaseConfig))  # MOMENTS_PHOTO_SIZES and the srcset widths
+    sizes = suffixes.keys()
+    try:
+        # thumbnails are written next to the image, work on copies
+        images = [Path(shutil.copy(path, workdir)) for path in args.images] if args.images else sample_images(workdir)
+        print(f'{"image":<28}{"per size ms":>13}{"single ms":>11}{"speedup":>9}')
+        totals = [0, 0]
+        for path in images:
+            before = cpu_time(
+                lambda path=path: [resize_image_per_size(path, path.name, width, workdir, suffixes) for width in sizes],
+                args.runs,
+            )
+            after = cpu_time(lambda path=path: create_thumbnails(path, path.name, suffixes), args.runs)
+            totals[0] += before
+            totals[1] += after
+            print(f'{path.name[:27]:<28}{before * 1000:>13.1f}{after * 1000:>11.1f}{before / after:>8.2f}x')
+        print(f'{"total":<28}{totals[0] * 1000:>13.1f}{totals[1] * 1000:>11.1f}{totals[0] / totals[1]:>8.2f}x')
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
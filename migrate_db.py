@@ -1,11 +1,56 @@
 #!/usr/bin/env python3
 """
-Database migration script to add ML fields to Photo table.
+Database migration script to add ML fields and counter columns to existing tables.
 """
 import sqlite3
 import sys
 from pathlib import Path
 
+# (table, column, DDL) added after the ML fields
+COLUMNS = [
+    ('user', 'followers_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('user', 'following_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('user', 'photos_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('user', 'collections_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('user', 'timeline_pulled', 'BOOLEAN NOT NULL DEFAULT 0'),
+    ('photo', 'collectors_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('photo', 'comments_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('tag', 'photos_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('photo', 'ml_status', 'VARCHAR(16)'),
+    ('photo', 'ml_analyzed_at', 'DATETIME'),
+    ('photo', 'ml_version', 'VARCHAR(255)'),
+    ('photo', 'image_formats', 'VARCHAR(32)'),
+    ('photo', 'thumbnails', 'TEXT'),
+    ('photo', 'width', 'INTEGER'),
+    ('photo', 'height', 'INTEGER'),
+    ('photo', 'placeholder', 'TEXT'),
+]
+
+# (index, table, columns) created after the counter columns
+INDEXES = [
+    ('ix_comment_photo_id', 'comment', 'photo_id'),
+    ('ix_tag_photos_count', 'tag', 'photos_count'),
+    ('ix_photo_collectors_count_id', 'photo', 'collectors_count, id'),
+]
+
+
+def add_columns(cursor, columns):
+    """Add each missing column, skipping the ones that already exist."""
+    for table, column, ddl in columns:
+        cursor.execute(f'PRAGMA table_info("{table}")')
+        if column in [row[1] for row in cursor.fetchall()]:
+            print(f"{table}.{column} column already exists")
+            continue
+        cursor.execute(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}')
+        print(f"Added {table}.{column} column")
+
+
+def add_indexes(cursor, indexes):
+    for name, table, columns in indexes:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({columns})')
+        print(f"Created index {name}")
+
+
 def migrate_database():
     """Add alt_text and detected_objects columns to the photo table."""
     db_path = Path(__file__).parent / 'data-dev.db'
@@ -33,9 +78,13 @@ def migrate_database():
             print("Added detected_objects column")
         else:
             print("detected_objects column already exists")
+
+        add_columns(cursor, COLUMNS)
+        add_indexes(cursor, INDEXES)
         
         conn.commit()
         print("Migration completed successfully!")
+        print("Run `flask init-db`, `flask recount` and `flask rebuild-timeline` to fill the new tables and counters.")
         
     except Exception as e:
         print(f"Migration failed: {e}")
@@ -7,10 +7,23 @@ from moments.blueprints.main import main_bp
 from moments.blueprints.user import user_bp
 from moments.core.commands import register_commands
 from moments.core.errors import register_error_handlers
-from moments.core.extensions import avatars, bootstrap, csrf, db, dropzone, login_manager, mail, whooshee
+from moments.core.extensions import (
+    avatars,
+    bootstrap,
+    broker,
+    cache,
+    csrf,
+    db,
+    derivatives,
+    dropzone,
+    login_manager,
+    mail,
+    whooshee,
+)
 from moments.core.logging import register_logging
 from moments.core.request import register_request_handlers
 from moments.core.templating import register_template_handlers
+from moments.ml_services import ml_analyzer
 from moments.settings import config
 
 
@@ -27,6 +40,10 @@ def create_app(config_name):
     whooshee.init_app(app)
     avatars.init_app(app)
     csrf.init_app(app)
+    cache.init_app(app)
+    broker.init_app(app)
+    derivatives.init_app(app)
+    ml_analyzer.init_app(app)
 
     app.register_blueprint(main_bp)
     app.register_blueprint(user_bp, url_prefix='/user')
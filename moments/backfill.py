@@ -0,0 +1,165 @@
+import contextlib
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from sqlalchemy import or_, select
+
+from moments.core.extensions import db
+from moments.jobs import job_handlers
+from moments.models import Photo
+
+
+def stale_photo_ids(model_version, after_id, limit):
+    """Return the ids of the photos never analyzed, or by other models, following ``after_id``.
+
+    Photos with a queued analysis are left to the workers.
+    """
+    stmt = (
+        select(Photo.id)
+        .filter(
+            Photo.id > after_id,
+            or_(Photo.ml_version.is_(None), Photo.ml_version != model_version),
+            Photo.ml_status.is_distinct_from('pending'),
+        )
+        .order_by(Photo.id)
+        .limit(limit)
+    )
+    return db.session.scalars(stmt).all()
+
+
+def analyze_photo_ids(photo_ids):
+    """Analyze a batch of photos and commit, return the numbers of analyzed and failed photos.
+
+    If the batch fails, its photos are analyzed one by one so a single bad file only fails itself.
+    """
+    analyze = job_handlers['analyze_photo']
+    photos = db.session.scalars(select(Photo).filter(Photo.id.in_(photo_ids)).order_by(Photo.id)).all()
+    try:
+        analyze(photos)
+        db.session.commit()
+        return len(photos), 0
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.warning(f'Backfill batch of {len(photos)} photos failed, retrying one by one: {e}')
+
+    failed = 0
+    for photo_id in photo_ids:
+        photo = db.session.get(Photo, photo_id)
+        if photo is None:  # deleted meanwhile
+            continue
+        try:
+            analyze([photo])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            photo.ml_status = 'failed'
+            db.session.commit()
+            failed += 1
+            current_app.logger.error(f'Backfill of photo {photo_id} failed: {e}')
+    return len(photos) - failed, failed
+
+
+class Checkpoint:
+    """Last photo id whose batch, and every batch before it, is done, kept in a JSON file.
+
+    A checkpoint written for another model version is ignored.
+    """
+
+    def __init__(self, path, model_version):
+        self.path = path
+        self.model_version = model_version
+        self.last_id = 0
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self.last_id
+        if data.get('model_version') == self.model_version:
+            self.last_id = data['last_id']
+        return self.last_id
+
+    def save(self, last_id):
+        self.last_id = last_id
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'model_version': self.model_version, 'last_id': last_id}, f)
+        os.replace(tmp_path, self.path)  # an interruption never leaves a truncated file
+
+    def clear(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+_process_app = None
+
+
+def _init_process(config_name):
+    global _process_app
+    from moments import create_app
+
+    _process_app = create_app(config_name)
+
+
+def _analyze_in_process(photo_ids):
+    with _process_app.app_context():
+        return analyze_photo_ids(photo_ids)
+
+
+def backfill(model_version, processes=1, rate=0, restart=False):
+    """Analyze every stale photo in batches, yielding ``(analyzed, failed, last_id)`` as batches finish.
+
+    The photos are streamed by ranges of ids and the checkpoint only moves past a batch once
+    it and every batch before it are done, so an interrupted run resumes where it stopped.
+    With ``processes`` above 1 the batches run in a pool of processes, each one with its own
+    app and models, or sharing ``flask ml-server`` when ``MOMENTS_ML_SERVER_URL`` is set.
+    ``rate`` caps the photos per second sent to analysis, 0 for no limit.
+    """
+    batch_size = current_app.config['MOMENTS_ML_BATCH_SIZE']
+    checkpoint = Checkpoint(current_app.config['MOMENTS_ML_BACKFILL_CHECKPOINT'], model_version)
+    if restart:
+        checkpoint.clear()
+    after_id = checkpoint.load()
+
+    executor = None
+    if processes > 1:
+        executor = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context('spawn'),  # a fresh interpreter, no inherited connections
+            initializer=_init_process,
+            initargs=(os.getenv('FLASK_CONFIG', 'development'),),
+        )
+    pending = deque()  # (last photo id, future or result) in id order
+    analyzed = failed = submitted = 0
+    start = time.monotonic()
+    try:
+        while True:
+            photo_ids = stale_photo_ids(model_version, after_id, batch_size)
+            if photo_ids:
+                if rate:
+                    time.sleep(max(submitted / rate - (time.monotonic() - start), 0))
+                after_id = photo_ids[-1]
+                submitted += len(photo_ids)
+                if executor is None:
+                    pending.append((after_id, analyze_photo_ids(photo_ids)))
+                else:
+                    pending.append((after_id, executor.submit(_analyze_in_process, photo_ids)))
+            # keep a couple of batches queued per process, then wait for the oldest one
+            while pending and (not photo_ids or len(pending) >= processes * 2 or executor is None):
+                last_id, result = pending.popleft()
+                batch_analyzed, batch_failed = result if executor is None else result.result()
+                analyzed += batch_analyzed
+                failed += batch_failed
+                checkpoint.save(last_id)
+                yield analyzed, failed, last_id
+            if not photo_ids:
+                return
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
@@ -1,3 +1,5 @@
+from datetime import datetime, timezone
+
 from flask import Blueprint, current_app, flash, render_template, request, abort, redirect, url_for
 from flask_login import login_required
 from sqlalchemy import func, select
@@ -5,7 +7,8 @@ from sqlalchemy import func, select
 from moments.core.extensions import db
 from moments.decorators import admin_required, permission_required
 from moments.forms.admin import EditProfileAdminForm
-from moments.models import Comment, Photo, Role, Tag, User
+from moments.models import Comment, Job, Photo, Role, Tag, User
+from moments.pagination import paginate
 from moments.utils import redirect_back
 
 admin_bp = Blueprint('admin', __name__)
@@ -23,6 +26,8 @@ def index():
     tag_count = db.session.scalar(select(func.count(Tag.id)))
     comment_count = db.session.scalar(select(func.count(Comment.id)))
     reported_comments_count = db.session.scalar(select(func.count(Comment.id)).filter(Comment.flag > 0))
+    pending_job_count = db.session.scalar(select(func.count(Job.id)).filter(Job.status != 'failed'))
+    failed_job_count = db.session.scalar(select(func.count(Job.id)).filter_by(status='failed'))
     return render_template(
         'admin/index.html',
         user_count=user_count,
@@ -33,6 +38,8 @@ def index():
         blocked_user_count=blocked_user_count,
         reported_comments_count=reported_comments_count,
         reported_photos_count=reported_photos_count,
+        pending_job_count=pending_job_count,
+        failed_job_count=failed_job_count,
     )
 
 
@@ -133,7 +140,6 @@ def delete_tag(tag_id):
 @permission_required('MODERATE')
 def manage_user():
     filter_rule = request.args.get('filter', 'all')  # 'all', 'locked', 'blocked', 'administrator', 'moderator'
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_MANAGE_USER_PER_PAGE']
     administrator = db.session.scalar(select(Role).filter_by(name='Administrator'))
     moderator = db.session.scalar(select(Role).filter_by(name='Moderator'))
@@ -149,7 +155,7 @@ def manage_user():
     else:
         filtered_users = select(User)
 
-    pagination = db.paginate(filtered_users.order_by(User.member_since.desc()), page=page, per_page=per_page)
+    pagination = paginate(filtered_users, (User.member_since, User.id), per_page=per_page)
     users = pagination.items
     return render_template('admin/manage_user.html', pagination=pagination, users=users)
 
@@ -163,10 +169,10 @@ def manage_photo(order):
     per_page = current_app.config['MOMENTS_MANAGE_PHOTO_PER_PAGE']
     order_rule = 'flag'
     if order == 'by_time':
-        pagination = db.paginate(select(Photo).order_by(Photo.created_at.desc()), page=page, per_page=per_page, error_out=False)
+        pagination = paginate(select(Photo), (Photo.created_at, Photo.id), per_page=per_page, error_out=False)
         order_rule = 'time'
     else:
-        pagination = db.paginate(select(Photo).order_by(Photo.flag.desc()), page=page, per_page=per_page, error_out=False)
+        pagination = paginate(select(Photo), (Photo.flag, Photo.id), per_page=per_page, error_out=False)
     if page > pagination.pages:
         return redirect(url_for('.manage_photo', page=pagination.pages, order_rule=order_rule))
     photos = pagination.items
@@ -177,9 +183,8 @@ def manage_photo(order):
 @login_required
 @permission_required('MODERATE')
 def manage_tag():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_MANAGE_TAG_PER_PAGE']
-    pagination = db.paginate(select(Tag).order_by(Tag.id.desc()), page=page, per_page=per_page)
+    pagination = paginate(select(Tag), (Tag.id,), per_page=per_page)
     tags = pagination.items
     return render_template('admin/manage_tag.html', pagination=pagination, tags=tags)
 
@@ -193,10 +198,10 @@ def manage_comment(order):
     per_page = current_app.config['MOMENTS_MANAGE_COMMENT_PER_PAGE']
     order_rule = 'flag'
     if order == 'by_time':
-        pagination = db.paginate(select(Comment).order_by(Comment.created_at.desc()), page=page, per_page=per_page, error_out=False)
+        pagination = paginate(select(Comment), (Comment.created_at, Comment.id), per_page=per_page, error_out=False)
         order_rule = 'time'
     else:
-        pagination = db.paginate(select(Comment).order_by(Comment.flag.desc()), page=page, per_page=per_page, error_out=False)
+        pagination = paginate(select(Comment), (Comment.flag, Comment.id), per_page=per_page, error_out=False)
     if page > pagination.pages:
         return redirect(url_for('.manage_comment', page=pagination.pages, order_rule=order_rule))
     comments = pagination.items
@@ -223,3 +228,48 @@ def delete_comment(comment_id):
     db.session.commit()
     flash('Comment deleted.', 'info')
     return redirect_back()
+
+
+@admin_bp.route('/manage/job')
+@login_required
+@permission_required('MODERATE')
+def manage_job():
+    filter_rule = request.args.get('filter', 'all')  # 'all', 'pending', 'failed'
+    per_page = current_app.config['MOMENTS_MANAGE_JOB_PER_PAGE']
+    if filter_rule == 'pending':
+        filtered_jobs = select(Job).filter(Job.status != 'failed')
+    elif filter_rule == 'failed':
+        filtered_jobs = select(Job).filter_by(status='failed')
+    else:
+        filtered_jobs = select(Job)
+    pagination = paginate(filtered_jobs, (Job.created_at, Job.id), per_page=per_page)
+    jobs = pagination.items
+    return render_template('admin/manage_job.html', pagination=pagination, jobs=jobs)
+
+
+@admin_bp.route('/retry/job/<int:job_id>', methods=['POST'])
+@login_required
+@permission_required('MODERATE')
+def retry_job(job_id):
+    job = db.session.get(Job, job_id) or abort(404)
+    if job.status == 'running':  # it would run twice
+        flash('Job is running.', 'warning')
+        return redirect_back()
+    job.status = 'pending'
+    job.attempts = 0
+    job.run_at = datetime.now(timezone.utc)
+    job.photo.ml_status = 'pending'
+    db.session.commit()
+    flash('Job queued.', 'info')
+    return redirect_back()
+
+
+@admin_bp.route('/delete/job/<int:job_id>', methods=['POST'])
+@login_required
+@permission_required('MODERATE')
+def delete_job(job_id):
+    job = db.session.get(Job, job_id) or abort(404)
+    db.session.delete(job)
+    db.session.commit()
+    flash('Job deleted.', 'info')
+    return redirect_back()
@@ -1,8 +1,11 @@
-from flask import Blueprint, render_template, abort
+import json
+import time
+
+from flask import Blueprint, Response, abort, current_app, jsonify, render_template, request
 from flask_login import current_user
-from sqlalchemy import func, select
+from sqlalchemy import select
 
-from moments.core.extensions import db
+from moments.core.extensions import broker, db
 from moments.models import Notification, Photo, User
 from moments.notifications import push_collect_notification, push_follow_notification
 
@@ -14,9 +17,53 @@ def notifications_count():
     if not current_user.is_authenticated:
         return {'message': 'Login required.'}, 403
 
-    stmt = current_user.notifications.select().filter_by(is_read=False).with_only_columns(func.count())
-    count = db.session.scalar(stmt)
-    return {'count': count}
+    response = jsonify(count=current_user.notifications_count)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # let the browser revalidate with the ETag on every poll
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+@ajax_bp.route('/notifications-stream')
+def notifications_stream():
+    """Server-Sent Events stream of the unread count, pushed only when it changes.
+
+    The stream closes after ``MOMENTS_NOTIFICATION_STREAM_TIMEOUT`` seconds and the browser
+    reconnects by itself, so a worker is never held by one client forever. It is only served
+    when ``MOMENTS_NOTIFICATION_STREAM`` is enabled, the badge polls the count otherwise.
+    """
+    if not current_app.config['MOMENTS_NOTIFICATION_STREAM']:
+        abort(404)
+    if not current_user.is_authenticated:
+        return {'message': 'Login required.'}, 403
+
+    # subscribe before reading the count, so nothing published in between is lost
+    subscription = broker.subscribe(Notification.stream_channel(current_user.id))
+    count = current_user.notifications_count
+    timeout = current_app.config['MOMENTS_NOTIFICATION_STREAM_TIMEOUT']
+    keepalive = current_app.config['MOMENTS_NOTIFICATION_STREAM_KEEPALIVE']
+
+    def generate():
+        try:
+            yield format_event('count', {'count': count})
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                message = subscription.get(timeout=min(keepalive, remaining))
+                if message is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield format_event(message['event'], message['data'])
+        finally:
+            subscription.close()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'  # don't let a proxy buffer the events
+    return response
 
 
 @ajax_bp.route('/profile/<int:user_id>')
@@ -1,15 +1,26 @@
 from flask import Blueprint, abort, current_app, flash, redirect, render_template, request, send_from_directory, url_for
 from flask_login import current_user, login_required
-from sqlalchemy import func, select
+from sqlalchemy import select
 from sqlalchemy.orm import with_parent
 
-from moments.core.extensions import db
+from moments.core.extensions import db, derivatives
 from moments.decorators import confirm_required, permission_required
+from moments.explore import get_explore_sampler
 from moments.forms.main import CommentForm, DescriptionForm, TagForm
-from moments.models import Collection, Comment, Follow, Notification, Photo, Tag, User
-from moments.notifications import push_collect_notification, push_comment_notification
-from moments.utils import flash_errors, redirect_back, rename_image, resize_image, validate_image
-from moments.ml_services import ml_analyzer
+from moments.jobs import enqueue_analysis
+from moments.models import Collection, Comment, Notification, Photo, Tag, User
+from moments.notifications import push_collect_notification, push_comment_notification, publish_notifications_count
+from moments.pagination import paginate
+from moments.relations import get_relations
+from moments.utils import (
+    alternative_filename,
+    flash_errors,
+    is_thumbnail,
+    redirect_back,
+    rename_image,
+    thumbnail_suffixes,
+    validate_image,
+)
 
 main_bp = Blueprint('main', __name__)
 
@@ -17,34 +28,21 @@ main_bp = Blueprint('main', __name__)
 @main_bp.route('/')
 def index():
     if current_user.is_authenticated:
-        page = request.args.get('page', 1, type=int)
         per_page = current_app.config['MOMENTS_PHOTO_PER_PAGE']
-        stmt = (
-            select(Photo)
-            .join(Follow, Follow.followed_id == Photo.author_id)
-            .filter(Follow.follower_id == current_user.id)
-            .order_by(Photo.created_at.desc())
-        )
-        pagination = db.paginate(stmt, page=page, per_page=per_page)
+        stmt, keys = current_user.get_timeline()
+        pagination = paginate(stmt, keys, per_page=per_page, cursor=True)
         photos = pagination.items
+        get_relations().load_photos(photos)
     else:
         pagination = None
         photos = None
-    stmt = (
-        select(Tag)
-        .join(Tag.photos)
-        .group_by(Tag.id)
-        .order_by(func.count(Photo.id).desc())
-        .limit(10)
-    )
-    tags = db.session.scalars(stmt).all()
+    tags = Tag.get_hot_tags()
     return render_template('main/index.html', pagination=pagination, photos=photos, tags=tags)
 
 
 @main_bp.route('/explore')
 def explore():
-    stmt = select(Photo).order_by(func.random()).limit(12)
-    photos = db.session.scalars(stmt).all()
+    photos = get_explore_sampler().sample(12)
     return render_template('main/explore.html', photos=photos)
 
 
@@ -67,6 +65,8 @@ def search():
     else:
         pagination = Photo.query.whooshee_search(q).paginate(page=page, per_page=per_page)
     results = pagination.items
+    if category == 'user':
+        get_relations().load_users(results)
     return render_template('main/search.html', q=q, results=results, pagination=pagination, category=category)
 
 
@@ -78,7 +78,6 @@ def search_by_objects():
         flash('Enter keyword to search for objects in photos.', 'warning')
         return redirect_back()
 
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_SEARCH_RESULT_PER_PAGE']
     
     # Search in both alt_text and detected_objects fields
@@ -88,10 +87,9 @@ def search_by_objects():
             (Photo.alt_text.ilike(f'%{q}%')) |
             (Photo.detected_objects.ilike(f'%{q}%'))
         )
-        .order_by(Photo.created_at.desc())
     )
     
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    pagination = paginate(stmt, (Photo.created_at, Photo.id), per_page=per_page)
     results = pagination.items
     
     return render_template('main/search.html', q=q, results=results, pagination=pagination, category='objects')
@@ -100,14 +98,13 @@ def search_by_objects():
 @main_bp.route('/notifications')
 @login_required
 def show_notifications():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_NOTIFICATION_PER_PAGE']
     stmt = current_user.notifications.select()
     filter_rule = request.args.get('filter')
     if filter_rule == 'unread':
         stmt = stmt.filter_by(is_read=False)
 
-    pagination = db.paginate(stmt.order_by(Notification.created_at.desc()), page=page, per_page=per_page)
+    pagination = paginate(stmt, (Notification.created_at, Notification.id), per_page=per_page)
     notifications = pagination.items
     return render_template('main/notifications.html', pagination=pagination, notifications=notifications)
 
@@ -121,6 +118,7 @@ def read_notification(notification_id):
 
     notification.is_read = True
     db.session.commit()
+    publish_notifications_count(current_user)
     flash('Notification archived.', 'success')
     return redirect(url_for('.show_notifications'))
 
@@ -133,13 +131,28 @@ def read_all_notification():
     for notification in notifications:
         notification.is_read = True
     db.session.commit()
+    if notifications:
+        publish_notifications_count(current_user)
     flash('All notifications archived.', 'success')
     return redirect(url_for('.show_notifications'))
 
 
 @main_bp.route('/images/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['MOMENTS_UPLOAD_PATH'], filename)
+    # serve the smallest format the browser explicitly accepts, a bare */* only gets the original,
+    # and the uploaded originals are always served untouched
+    upload_path = current_app.config['MOMENTS_UPLOAD_PATH']
+    accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+    thumbnail = is_thumbnail(filename, thumbnail_suffixes(current_app.config))
+    for fmt in current_app.config['MOMENTS_PHOTO_FORMATS'] if thumbnail else []:
+        alternative = alternative_filename(filename, fmt)
+        if f'image/{fmt}' in accepted and alternative != filename and (upload_path / alternative).is_file():
+            response = send_from_directory(upload_path, alternative, mimetype=f'image/{fmt}')
+            break
+    else:
+        response = send_from_directory(upload_path, filename)
+    response.vary.add('Accept')
+    return response
 
 
 @main_bp.route('/avatars/<path:filename>')
@@ -160,40 +173,14 @@ def upload():
             return 'Invalid image.', 400
         filename = rename_image(f.filename)
         f.save(current_app.config['MOMENTS_UPLOAD_PATH'] / filename)
-        filename_s = resize_image(f, filename, current_app.config['MOMENTS_PHOTO_SIZES']['small'])
-        filename_m = resize_image(f, filename, current_app.config['MOMENTS_PHOTO_SIZES']['medium'])
-        
-        # Create photo object
+        # the original stands in for the thumbnails until the derivative pool has created them
         photo = Photo(
-            filename=filename, filename_s=filename_s, filename_m=filename_m, author=current_user._get_current_object()
+            filename=filename, filename_s=filename, filename_m=filename, author=current_user._get_current_object()
         )
         db.session.add(photo)
+        enqueue_analysis(photo)  # alt text and object detection run in `flask worker`
         db.session.commit()
-        
-        # Generate ML analysis asynchronously (in a real app, use Celery or similar)
-        try:
-            image_path = current_app.config['MOMENTS_UPLOAD_PATH'] / filename
-            
-            # Generate alternative text
-            alt_text = ml_analyzer.generate_alt_text(str(image_path))
-            photo.alt_text = alt_text
-            
-            # Auto-populate description with alt text if no description provided
-            if not photo.description or photo.description.strip() == "":
-                photo.description = alt_text
-                current_app.logger.info(f"Auto-populated description with alt text for photo {photo.id}")
-            
-            # Detect objects
-            detected_objects = ml_analyzer.detect_objects(str(image_path))
-            photo.set_detected_objects(detected_objects)
-            
-            db.session.commit()
-            current_app.logger.info(f"ML analysis completed for photo {photo.id}")
-            
-        except Exception as e:
-            current_app.logger.error(f"ML analysis failed for photo {photo.id}: {e}")
-            # Continue without ML analysis - don't fail the upload
-        
+        derivatives.submit(photo.id, current_app.config['MOMENTS_UPLOAD_PATH'] / filename, filename)
     return render_template('main/upload.html')
 
 
@@ -309,11 +296,11 @@ def report_photo(photo_id):
 @main_bp.route('/photo/<int:photo_id>/collectors')
 def show_collectors(photo_id):
     photo = db.session.get(Photo, photo_id) or abort(404)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_USER_PER_PAGE']
-    stmt = photo.collections.select().order_by(Collection.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = photo.collections.select()
+    pagination = paginate(stmt, (Collection.created_at, Collection.user_id), per_page=per_page)
     collections = pagination.items
+    get_relations().load_users([collection.user for collection in collections])
     return render_template('main/collectors.html', collections=collections, photo=photo, pagination=pagination)
 
 
@@ -453,15 +440,11 @@ def delete_comment(comment_id):
 @main_bp.route('/tag/<int:tag_id>')
 def show_tag(tag_id):
     tag = db.session.get(Tag, tag_id) or abort(404)
-    page = request.args.get('page', 1, type=int)
     order_rule = request.args.get('order_rule', 'time')
     per_page = current_app.config['MOMENTS_PHOTO_PER_PAGE']
-    stmt = tag.photos.select().order_by(Photo.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    keys = (Photo.collectors_count, Photo.id) if order_rule == 'collections' else (Photo.created_at, Photo.id)
+    pagination = paginate(tag.photos.select(), keys, per_page=per_page, cursor=True)
     photos = pagination.items
-
-    if order_rule == 'collections':
-        photos.sort(key=lambda x: x.collectors_count, reverse=True)
     return render_template('main/tag.html', tag=tag, pagination=pagination, photos=photos, order_rule=order_rule)
 
 
@@ -17,6 +17,8 @@ from moments.forms.user import (
 )
 from moments.models import Collection, Follow, Photo, User
 from moments.notifications import push_follow_notification
+from moments.pagination import paginate
+from moments.relations import get_relations
 from moments.settings import Operations
 from moments.utils import flash_errors, generate_token, parse_token, redirect_back
 
@@ -32,10 +34,9 @@ def index(username):
     if user == current_user and not user.active:
         logout_user()
 
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_PHOTO_PER_PAGE']
-    stmt = user.photos.select().order_by(Photo.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = user.photos.select()
+    pagination = paginate(stmt, (Photo.created_at, Photo.id), per_page=per_page, cursor=True)
     photos = pagination.items
     return render_template('user/index.html', user=user, pagination=pagination, photos=photos)
 
@@ -43,10 +44,9 @@ def index(username):
 @user_bp.route('/<username>/collections')
 def show_collections(username):
     user = db.session.scalar(select(User).filter_by(username=username)) or abort(404)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_PHOTO_PER_PAGE']
-    stmt = user.collections.select().order_by(Collection.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = user.collections.select()
+    pagination = paginate(stmt, (Collection.created_at, Collection.photo_id), per_page=per_page, cursor=True)
     collections = pagination.items
     return render_template('user/collections.html', user=user, pagination=pagination, collections=collections)
 
@@ -83,22 +83,22 @@ def unfollow(username):
 @user_bp.route('/<username>/followers')
 def show_followers(username):
     user = db.session.scalar(select(User).filter_by(username=username)) or abort(404)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_USER_PER_PAGE']
-    stmt = user.followers.select().order_by(Follow.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = user.followers.select()
+    pagination = paginate(stmt, (Follow.created_at, Follow.follower_id), per_page=per_page, cursor=True)
     follows = pagination.items
+    get_relations().load_users([user] + [follow.follower for follow in follows])
     return render_template('user/followers.html', user=user, pagination=pagination, follows=follows)
 
 
 @user_bp.route('/<username>/following')
 def show_following(username):
     user = db.session.scalar(select(User).filter_by(username=username)) or abort(404)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MOMENTS_USER_PER_PAGE']
-    stmt = user.following.select().order_by(Follow.created_at.desc())
-    pagination = db.paginate(stmt, page=page, per_page=per_page)
+    stmt = user.following.select()
+    pagination = paginate(stmt, (Follow.created_at, Follow.followed_id), per_page=per_page, cursor=True)
     follows = pagination.items
+    get_relations().load_users([user] + [follow.followed for follow in follows])
     return render_template('user/following.html', user=user, pagination=pagination, follows=follows)
 
 
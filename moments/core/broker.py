@@ -0,0 +1,106 @@
+import contextlib
+import json
+import queue
+import threading
+from collections import defaultdict
+
+from flask import current_app
+
+
+class LocalSubscription:
+    def __init__(self, broker, channel, maxsize):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize)
+
+    def get(self, timeout=None):
+        """Wait for the next message, return None if nothing was published within ``timeout`` seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """In-process pub/sub, only reaches the subscribers connected to the same worker."""
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = LocalSubscription(self, channel, self.maxsize)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            with contextlib.suppress(queue.Full):  # a stalled client only misses intermediate updates
+                subscription.queue.put_nowait(message)
+
+
+class RedisSubscription:
+    def __init__(self, client, channel):
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def get(self, timeout=None):
+        message = self.pubsub.get_message(timeout=timeout)
+        return None if message is None else json.loads(message['data'])
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker:
+    """Pub/sub shared by every worker through Redis, messages are sent as JSON."""
+
+    def __init__(self, url, key_prefix='moments:'):
+        import redis  # optional dependency, only needed for the shared backend
+
+        self.client = redis.Redis.from_url(url)
+        self.key_prefix = key_prefix
+
+    def subscribe(self, channel):
+        return RedisSubscription(self.client, self.key_prefix + channel)
+
+    def publish(self, channel, message):
+        self.client.publish(self.key_prefix + channel, json.dumps(message))
+
+
+class Broker:
+    """Pick the pub/sub backend from ``MOMENTS_BROKER_BACKEND`` and proxy to the one of the current app."""
+
+    def init_app(self, app):
+        backend = app.config['MOMENTS_BROKER_BACKEND']
+        if backend == 'memory':
+            app.extensions['moments_broker'] = LocalBroker()
+        elif backend == 'redis':
+            app.extensions['moments_broker'] = RedisBroker(app.config['MOMENTS_BROKER_REDIS_URL'])
+        else:
+            raise ValueError(f'Unknown broker backend: {backend}')
+
+    @property
+    def backend(self):
+        return current_app.extensions['moments_broker']
+
+    def subscribe(self, channel):
+        return self.backend.subscribe(channel)
+
+    def publish(self, channel, message):
+        self.backend.publish(channel, message)
@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class LRUCache:
+    """In-process cache with a size bound and per-key expiry, shared by the threads of one worker."""
+
+    def __init__(self, maxsize=10000, default_timeout=300):
+        self.maxsize = maxsize
+        self.default_timeout = default_timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expires_at(self, timeout):
+        timeout = self.default_timeout if timeout is None else timeout
+        return time.monotonic() + timeout if timeout else None
+
+    def _get_entry(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._get_entry(key)
+            return None if entry is None else entry[0]
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._data[key] = (value, self._expires_at(timeout))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, delta=1):
+        """Add ``delta`` to a cached integer, return the new value or None if the key is missing."""
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                return None
+            self._data[key] = (entry[0] + delta, entry[1])
+            return entry[0] + delta
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """Cache shared by every worker through Redis, values are stored as JSON."""
+
+    # only touch existing keys, a missing counter is rebuilt from the database on the next read
+    INCR_SCRIPT = "if redis.call('exists', KEYS[1]) == 1 then return redis.call('incrby', KEYS[1], ARGV[1]) end"
+
+    def __init__(self, url, key_prefix='moments:', default_timeout=300):
+        import redis  # optional dependency, only needed for the shared backend
+
+        self.client = redis.Redis.from_url(url)
+        self.key_prefix = key_prefix
+        self.default_timeout = default_timeout
+        self._incr = self.client.register_script(self.INCR_SCRIPT)
+
+    def get(self, key):
+        value = self.client.get(self.key_prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        self.client.set(self.key_prefix + key, json.dumps(value), ex=timeout or None)
+
+    def delete(self, key):
+        self.client.delete(self.key_prefix + key)
+
+    def incr(self, key, delta=1):
+        return self._incr(keys=[self.key_prefix + key], args=[delta])
+
+    def clear(self):
+        for key in self.client.scan_iter(self.key_prefix + '*'):
+            self.client.delete(key)
+
+
+class Cache:
+    """Pick the cache backend from ``MOMENTS_CACHE_BACKEND`` and proxy to the one of the current app."""
+
+    def init_app(self, app):
+        backend = app.config['MOMENTS_CACHE_BACKEND']
+        timeout = app.config['MOMENTS_CACHE_DEFAULT_TIMEOUT']
+        if backend == 'memory':
+            app.extensions['moments_cache'] = LRUCache(app.config['MOMENTS_CACHE_SIZE'], timeout)
+        elif backend == 'redis':
+            app.extensions['moments_cache'] = RedisCache(app.config['MOMENTS_CACHE_REDIS_URL'], default_timeout=timeout)
+        else:
+            raise ValueError(f'Unknown cache backend: {backend}')
+
+    @property
+    def backend(self):
+        return current_app.extensions['moments_cache']
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def incr(self, key, delta=1):
+        return self.backend.incr(key, delta)
+
+    def clear(self):
+        self.backend.clear()
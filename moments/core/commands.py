@@ -1,7 +1,8 @@
 import click
+from sqlalchemy import func, select, update
 
-from moments.core.extensions import db
-from moments.models import Role
+from moments.core.extensions import cache, db
+from moments.models import Collection, Comment, Follow, Photo, Role, Tag, Timeline, User, photo_tag
 
 
 def register_commands(app):
@@ -25,6 +26,183 @@ def register_commands(app):
         Role.init_role()
         click.echo('Initialized the roles and permissions.')
 
+    @app.cli.command('rebuild-timeline')
+    def rebuild_timeline_command():
+        """Rebuild the home timelines from the follow graph."""
+        Timeline.rebuild()
+        click.echo('Rebuilt the timelines.')
+
+    @app.cli.command('backfill-placeholders')
+    @click.option('--batch', default=100, help='Photos per commit, default is 100.')
+    def backfill_placeholders_command(batch):
+        """Create the missing placeholders and dimensions of existing photos."""
+        from PIL import Image
+
+        from moments.utils import create_placeholder
+
+        upload_path = app.config['MOMENTS_UPLOAD_PATH']
+        last_id = created = 0
+        while True:
+            stmt = select(Photo).filter(Photo.id > last_id, Photo.placeholder.is_(None)).order_by(Photo.id).limit(batch)
+            photos = db.session.scalars(stmt).all()
+            if not photos:
+                break
+            for photo in photos:
+                thumbnails = photo.get_thumbnails()
+                try:
+                    if photo.width is None:  # only reads the header
+                        with Image.open(upload_path / photo.filename) as img:
+                            photo.width, photo.height = img.size
+                    with Image.open(upload_path / (thumbnails[0].filename if thumbnails else photo.filename_s)) as img:
+                        photo.placeholder = create_placeholder(img)
+                except OSError as e:
+                    click.echo(f'Skipped photo {photo.id}: {e}')
+                    continue
+                created += photo.placeholder is not None
+            db.session.commit()
+            last_id = photos[-1].id
+        click.echo(f'Created {created} placeholders.')
+
+    @app.cli.command('regenerate-thumbnails')
+    @click.option('--batch', default=100, help='Photos per query, default is 100.')
+    def regenerate_thumbnails_command(batch):
+        """Create the thumbnails of photos still serving the original, e.g. after a server restart."""
+        from moments.core.extensions import derivatives
+        from moments.utils import create_thumbnails, thumbnail_suffixes
+
+        upload_path = app.config['MOMENTS_UPLOAD_PATH']
+        suffixes, formats = thumbnail_suffixes(app.config), app.config['MOMENTS_PHOTO_FORMATS']
+        last_id = created = 0
+        while True:
+            stmt = select(Photo.id, Photo.filename).filter(Photo.id > last_id, Photo.width.is_(None))
+            photos = db.session.execute(stmt.order_by(Photo.id).limit(batch)).all()
+            if not photos:
+                break
+            for photo_id, filename in photos:
+                try:
+                    result = create_thumbnails(upload_path / filename, filename, suffixes, formats)
+                except OSError as e:
+                    click.echo(f'Skipped photo {photo_id}: {e}')
+                    continue
+                derivatives.pool.apply(photo_id, result)
+                created += 1
+            last_id = photos[-1].id
+        click.echo(f'Created the thumbnails of {created} photos.')
+
+    @app.cli.command('recount')
+    def recount_command():
+        """Recalculate the denormalized counters."""
+
+        def count(*criteria):
+            return select(func.count()).filter(*criteria).scalar_subquery()
+
+        statements = [
+            update(User).values(
+                followers_count=count(Follow.followed_id == User.id, Follow.follower_id != User.id),
+                following_count=count(Follow.follower_id == User.id, Follow.followed_id != User.id),
+                photos_count=count(Photo.author_id == User.id),
+                collections_count=count(Collection.user_id == User.id),
+            ),
+            update(Photo).values(
+                collectors_count=count(Collection.photo_id == Photo.id),
+                comments_count=count(Comment.photo_id == Photo.id),
+            ),
+            update(Tag).values(photos_count=count(photo_tag.c.tag_id == Tag.id)),
+        ]
+        for stmt in statements:
+            db.session.execute(stmt.execution_options(synchronize_session=False))
+        db.session.commit()
+        cache.delete(Tag.HOT_TAGS_KEY)
+        click.echo('Recounted the counters.')
+
+    @app.cli.command('worker')
+    @click.option('--burst', is_flag=True, help='Exit once the queue is empty.')
+    @click.option('--warm-up/--no-warm-up', default=None, help='Load ML models first, default is MOMENTS_ML_WARMUP.')
+    def worker_command(burst, warm_up):
+        """Run the queued background jobs."""
+        from moments.jobs import work
+
+        if warm_up is None:
+            warm_up = app.config['MOMENTS_ML_WARMUP']
+        if warm_up:
+            from moments.ml_services import ml_analyzer
+
+            if ml_analyzer.server_url:
+                click.echo('Models are served by the inference server, skipping the warm-up.')
+            else:
+                click.echo(f'Models warmed up in {ml_analyzer.warm_up():.2f}s.')
+        click.echo('Worker started.')
+        processed = work(burst=burst)
+        click.echo(f'Processed {processed} jobs.')
+
+    @app.cli.command('ml-server')
+    @click.option('--host', default='127.0.0.1', help='Interface to listen on, default is 127.0.0.1.')
+    @click.option('--port', default=5001, help='Port to listen on, default is 5001.')
+    def ml_server_command(host, port):
+        """Run the inference server shared by the workers."""
+        from moments.ml_server import create_server
+        from moments.ml_services import MLAnalyzer
+
+        analyzer = MLAnalyzer.create(app.config)  # always in-process here
+        # requests are accepted right away, GET /health reports when the models are ready
+        server = create_server(
+            analyzer,
+            host,
+            port,
+            app.config['MOMENTS_ML_BATCH_SIZE'],
+            app.config['MOMENTS_ML_SERVER_BATCH_WAIT'],
+            warm_up=True,
+            upload_path=app.config['MOMENTS_UPLOAD_PATH'],
+        )
+        click.echo(f'Inference server listening on http://{host}:{port}, set MOMENTS_ML_SERVER_URL to use it.')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+
+    @app.cli.command('ml-compare')
+    @click.argument('images', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+    @click.option('--backend', 'backends', multiple=True, default=['int8', 'exported'], help='Backend to compare.')
+    @click.option('--limit', default=20, help='Quantity of recent photos used without IMAGES, default is 20.')
+    def ml_compare_command(images, backends, limit):
+        """Compare the latency and output drift of the inference backends against fp32."""
+        from moments.ml_services import compare_backends
+
+        if not images:
+            stmt = select(Photo.filename).order_by(Photo.id.desc()).limit(limit)
+            paths = [app.config['MOMENTS_UPLOAD_PATH'] / filename for filename in db.session.scalars(stmt)]
+            images = [str(path) for path in paths if path.exists()]
+        if not images:
+            raise click.UsageError('No images to analyze.')
+        click.echo(f'Comparing on {len(images)} images.')
+        rows = compare_backends(images, backends)
+        click.echo(f'{"backend":<10}{"ms/image":>10}{"speedup":>9}{"caption =":>11}{"caption ~":>11}{"label F1":>10}')
+        for row in rows:
+            click.echo(
+                f'{row["backend"]:<10}{row["latency"]:>10.1f}{rows[0]["latency"] / row["latency"]:>8.2f}x'
+                f'{row["caption_match"]:>11.1%}{row["caption_similarity"]:>11.1%}{row["label_f1"]:>10.1%}'
+            )
+
+    @app.cli.command('ml-backfill')
+    @click.option('--processes', type=int, help='Worker processes, default is MOMENTS_ML_BACKFILL_PROCESSES.')
+    @click.option('--rate', type=float, help='Photos per second, 0 for no limit, default is MOMENTS_ML_BACKFILL_RATE.')
+    @click.option('--restart', is_flag=True, help='Ignore the checkpoint and scan from the first photo.')
+    def ml_backfill_command(processes, rate, restart):
+        """Analyze the photos never analyzed, or by older models."""
+        from moments.backfill import backfill
+        from moments.ml_services import ml_analyzer
+
+        if processes is None:
+            processes = app.config['MOMENTS_ML_BACKFILL_PROCESSES']
+        if rate is None:
+            rate = app.config['MOMENTS_ML_BACKFILL_RATE']
+        model_version = ml_analyzer.model_version(app.config['MOMENTS_ML_CAPTION_PROFILE'])
+        click.echo(f'Backfilling photos for {model_version}.')
+        analyzed = failed = 0
+        for analyzed, failed, last_id in backfill(model_version, processes, rate, restart):
+            click.echo(f'{analyzed} photos analyzed, {failed} failed, up to photo {last_id}.')
+        click.echo(f'Done, {analyzed} photos analyzed, {failed} failed.')
+
     @app.cli.command('lorem')
     @click.option('--user', default=10, help='Quantity of users, default is 10.')
     @click.option('--follow', default=30, help='Quantity of follows, default is 30.')
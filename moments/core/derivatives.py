@@ -0,0 +1,119 @@
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from sqlalchemy import update
+
+from moments.utils import alternative_filename, create_thumbnails, thumbnail_suffixes
+
+
+class DerivativePool:
+    """Create the thumbnails of uploads in a bounded pool of processes, off the request thread.
+
+    The photo keeps the original as its thumbnails until the pool is done, then its filenames
+    are switched to the new files. Past ``max_pending`` unfinished uploads, the thumbnails are
+    created in the request again, so a burst cannot queue unbounded work.
+
+    Each server process owns its pool, so ``workers`` and ``max_pending`` apply per process.
+    Photos whose thumbnails were lost with a process are recreated by ``flask regenerate-thumbnails``.
+    """
+
+    def __init__(self, app, workers, max_pending):
+        self.app = app
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # created on first use, so each server process forked after create_app owns its pool
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def submit(self, photo_id, path, filename):
+        with self._lock:
+            inline = self.pending >= self.max_pending
+            if not inline:
+                self.pending += 1
+        args = (path, filename, thumbnail_suffixes(self.app.config), self.app.config['MOMENTS_PHOTO_FORMATS'])
+        if inline:
+            self.apply(photo_id, create_thumbnails(*args))
+            return
+        try:
+            future = self.executor.submit(create_thumbnails, *args)
+        except Exception as e:  # e.g. a broken pool after a worker died
+            with self._lock:
+                self.pending -= 1
+            current_app.logger.error(f'Queueing the thumbnails of photo {photo_id} failed, creating them now: {e}')
+            self.apply(photo_id, create_thumbnails(*args))
+            return
+        future.add_done_callback(lambda future: self._done(photo_id, future))
+
+    def _done(self, photo_id, future):
+        try:
+            with self.app.app_context():
+                try:
+                    result = future.result()
+                except Exception as e:  # the photo keeps serving the original
+                    current_app.logger.error(f'Creating the thumbnails of photo {photo_id} failed: {e}')
+                    return
+                self.apply(photo_id, result)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def apply(self, photo_id, result):
+        from moments.core.extensions import db
+        from moments.models import Photo
+
+        sizes = current_app.config['MOMENTS_PHOTO_SIZES']
+        srcset = sorted(set(result.thumbnails.values()), key=lambda thumbnail: thumbnail.width)
+        updated = db.session.execute(
+            update(Photo)
+            .where(Photo.id == photo_id)
+            .values(
+                filename_s=result.thumbnails[sizes['small']].filename,
+                filename_m=result.thumbnails[sizes['medium']].filename,
+                image_formats=','.join(result.formats) or None,
+                width=result.original.width,
+                height=result.original.height,
+                thumbnails=json.dumps(srcset),
+                placeholder=result.placeholder,
+            )
+        )
+        db.session.commit()
+        if updated.rowcount == 0:  # the photo was deleted meanwhile
+            for filename in {thumbnail.filename for thumbnail in srcset}:
+                for name in [filename, *(alternative_filename(filename, fmt) for fmt in result.formats)]:
+                    path = current_app.config['MOMENTS_UPLOAD_PATH'] / name
+                    if path.exists():
+                        path.unlink()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+class Derivatives:
+    """Run the thumbnail creation of the current app, in the request when ``MOMENTS_DERIVATIVE_WORKERS`` is 0."""
+
+    def init_app(self, app):
+        workers = app.config['MOMENTS_DERIVATIVE_WORKERS']
+        max_pending = app.config['MOMENTS_DERIVATIVE_MAX_PENDING'] if workers else 0
+        app.extensions['moments_derivatives'] = DerivativePool(app, workers, max_pending)
+
+    @property
+    def pool(self):
+        return current_app.extensions['moments_derivatives']
+
+    def submit(self, photo_id, path, filename):
+        """Create the thumbnails of an uploaded photo, which serves the original until they exist."""
+        self.pool.submit(photo_id, path, filename)
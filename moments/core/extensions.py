@@ -9,6 +9,10 @@ from flask_wtf import CSRFProtect
 from sqlalchemy import MetaData
 from sqlalchemy.orm import DeclarativeBase
 
+from moments.core.broker import Broker
+from moments.core.cache import Cache
+from moments.core.derivatives import Derivatives
+
 
 class Base(DeclarativeBase):
     metadata = MetaData(
@@ -30,6 +34,9 @@ dropzone = Dropzone()
 whooshee = Whooshee()
 avatars = Avatars()
 csrf = CSRFProtect()
+cache = Cache()
+broker = Broker()
+derivatives = Derivatives()
 
 
 @login_manager.user_loader
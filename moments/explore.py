@@ -0,0 +1,70 @@
+import random
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload
+
+from moments.core.extensions import db
+from moments.models import Photo
+
+
+class ExploreSampler:
+    """Pick random unflagged photos without sorting the whole photo table.
+
+    A pool of up to ``pool_size`` eligible photo ids is kept in memory and rebuilt every
+    ``timeout`` seconds. When the table holds more than that, the pool is gathered from
+    short runs of ids starting at random points of the id range, each one an index range
+    scan on the primary key, so the cost of a refresh does not grow with the table.
+    """
+
+    RUN_LENGTH = 50
+
+    def __init__(self, pool_size, timeout):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pool = []
+        self.expires_at = 0
+        self._lock = threading.Lock()
+
+    def eligible(self):
+        return select(Photo.id).filter(Photo.flag == 0)
+
+    def load_pool(self):
+        photo_ids = db.session.scalars(self.eligible().order_by(Photo.id).limit(self.pool_size + 1)).all()
+        if len(photo_ids) <= self.pool_size:  # small table, every eligible photo fits
+            return photo_ids
+
+        min_id, max_id = db.session.execute(select(func.min(Photo.id), func.max(Photo.id))).one()
+        pool = set()
+        for _ in range(self.pool_size // self.RUN_LENGTH):
+            start = random.randint(min_id, max_id)
+            stmt = self.eligible().filter(Photo.id >= start).order_by(Photo.id).limit(self.RUN_LENGTH)
+            pool.update(db.session.scalars(stmt))
+        return list(pool)
+
+    def get_pool(self):
+        with self._lock:
+            if time.monotonic() >= self.expires_at:
+                self.pool = self.load_pool()
+                self.expires_at = time.monotonic() + self.timeout
+            return self.pool
+
+    def sample(self, number):
+        pool = self.get_pool()
+        photo_ids = random.sample(pool, min(number, len(pool)))
+        # photos deleted or flagged since the last refresh are dropped here
+        stmt = select(Photo).filter(Photo.id.in_(photo_ids), Photo.flag == 0).options(selectinload(Photo.author))
+        photos = db.session.scalars(stmt).all()
+        random.shuffle(photos)
+        return photos
+
+
+def get_explore_sampler():
+    """Return the explore sampler of the current app, one per process."""
+    if 'moments_explore' not in current_app.extensions:
+        current_app.extensions['moments_explore'] = ExploreSampler(
+            current_app.config['MOMENTS_EXPLORE_POOL_SIZE'], current_app.config['MOMENTS_EXPLORE_POOL_TIMEOUT']
+        )
+    return current_app.extensions['moments_explore']
@@ -0,0 +1,261 @@
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from moments.core.extensions import db
+from moments.ml_services import AnalysisError, ml_analyzer
+from moments.models import AnalysisResult, Job
+
+job_handlers = {}
+
+
+def job_handler(kind):
+    """Register the function that runs the jobs of ``kind``, it receives the photos of a batch of jobs."""
+
+    def decorator(func):
+        job_handlers[kind] = func
+        return func
+
+    return decorator
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def analyze_uncached(analyzer, image_paths, digests, model_version):
+    """Return the analysis of each image, only running the models on contents never analyzed before.
+
+    New results are stored in ``AnalysisResult``, the caller commits. A result stored meanwhile
+    by another process wins over the one just computed. The images the models failed on get
+    None and are never stored, so the next attempt runs the models again.
+    """
+    cached = {
+        result.sha256: result
+        for result in db.session.scalars(
+            select(AnalysisResult).filter(
+                AnalysisResult.sha256.in_(set(digests)), AnalysisResult.model_version == model_version
+            )
+        )
+    }
+    # identical files in the same batch are analyzed once
+    missing = {}
+    for path, digest in zip(image_paths, digests):
+        if digest not in cached:
+            missing.setdefault(digest, path)
+    hits = len(digests) - len(missing)
+    saved = 0
+    for digest in digests:
+        if digest in cached:
+            cached[digest].hits += 1
+            saved += cached[digest].inference_time
+
+    if missing:
+        start = time.perf_counter()
+        results = analyzer.analyze_batch(
+            list(missing.values()),
+            batch_size=current_app.config['MOMENTS_ML_BATCH_SIZE'],
+            profile=current_app.config['MOMENTS_ML_CAPTION_PROFILE'],
+            backlog=pending_job_count('analyze_photo'),
+        )
+        inference_time = (time.perf_counter() - start) / len(missing)
+        for digest, result in zip(missing, results):
+            if result.get('error'):
+                current_app.logger.warning(f'ML analysis of {missing[digest]} failed: {result["error"]}')
+                continue
+            cached[digest] = AnalysisResult(
+                sha256=digest,
+                model_version=model_version,
+                alt_text=result['alt_text'],
+                objects=json.dumps(result['objects']),
+                inference_time=inference_time,
+            )
+            try:
+                with db.session.begin_nested():
+                    db.session.add(cached[digest])
+            except IntegrityError:  # stored meanwhile by another worker or the backfill, keep theirs
+                cached[digest] = db.session.scalar(
+                    select(AnalysisResult).filter_by(sha256=digest, model_version=model_version)
+                )
+
+    current_app.logger.info(f'ML cache: {hits}/{len(digests)} hits, saved {saved:.2f}s of inference')
+    return [cached.get(digest) for digest in digests]
+
+
+@job_handler('analyze_photo')
+def analyze_photos(photos):
+    """Store the analysis of the photos, raise ``AnalysisError`` if the models failed on any of them."""
+    image_paths = [str(current_app.config['MOMENTS_UPLOAD_PATH'] / photo.filename) for photo in photos]
+    digests = [file_sha256(path) for path in image_paths]
+    model_version = ml_analyzer.model_version(current_app.config['MOMENTS_ML_CAPTION_PROFILE'])
+    results = analyze_uncached(ml_analyzer, image_paths, digests, model_version)
+    failed = [photo.id for photo, result in zip(photos, results) if result is None]
+    if failed:  # the jobs are retried with backoff, one by one if the batch had others
+        raise AnalysisError(f'The models failed on photos {failed}')
+    for photo, result in zip(photos, results):
+        photo.alt_text = result.alt_text
+        # auto-populate description with alt text if no description provided
+        if not photo.description or photo.description.strip() == '':
+            photo.description = result.alt_text
+        photo.detected_objects = result.objects
+        photo.ml_status = 'done'
+        photo.ml_analyzed_at = datetime.now(timezone.utc)
+        photo.ml_version = model_version
+    current_app.logger.info(f'ML analysis completed for photos {[photo.id for photo in photos]}')
+
+
+def pending_job_count(kind):
+    return db.session.scalar(select(func.count(Job.id)).filter(Job.kind == kind, Job.status == 'pending'))
+
+
+def enqueue_analysis(photo):
+    """Queue the ML analysis of a photo, the caller commits."""
+    photo.ml_status = 'pending'
+    db.session.add(Job(kind='analyze_photo', photo=photo))
+
+
+def claim_job(kind=None):
+    """Mark the next due job (of ``kind`` if given) as running and return it, or None if nothing is due.
+
+    The claim is a conditional UPDATE on the job status, so concurrent workers never
+    run the same job twice.
+    """
+    now = datetime.now(timezone.utc)
+    while True:
+        stmt = select(Job.id).filter(Job.status == 'pending', Job.run_at <= now).order_by(Job.run_at, Job.id).limit(1)
+        if kind is not None:
+            stmt = stmt.filter(Job.kind == kind)
+        job_id = db.session.scalar(stmt)
+        if job_id is None:
+            return None
+        result = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == 'pending')
+            .values(status='running', started_at=now, attempts=Job.attempts + 1)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return db.session.get(Job, job_id)
+
+
+def claimed_by(claims):
+    """Match the jobs still held by the runs that claimed them, ``claims`` maps job ids to their ``started_at``.
+
+    A job released as stale no longer matches, so a run that was only slow cannot finish it anymore.
+    """
+    return or_(
+        *[
+            and_(Job.id == job_id, Job.status == 'running', Job.started_at == started_at)
+            for job_id, started_at in claims.items()
+        ]
+    )
+
+
+def release_stale_jobs():
+    """Put the jobs of a worker that died mid-run, or is past ``MOMENTS_JOB_TIMEOUT``, back in the queue."""
+    now = datetime.now(timezone.utc)
+    stale = now - timedelta(seconds=current_app.config['MOMENTS_JOB_TIMEOUT'])
+    stmt = select(Job.id, Job.started_at).filter(Job.status == 'running', Job.started_at < stale)
+    for job_id, started_at in db.session.execute(stmt).all():
+        # conditional on the claim, a job finished or re-claimed meanwhile is left alone
+        result = db.session.execute(
+            update(Job).where(claimed_by({job_id: started_at})).values(status='pending', run_at=now)
+        )
+        if result.rowcount == 1:
+            current_app.logger.warning(f'Job {job_id} has been running since {started_at}, queued it again')
+    db.session.commit()
+
+
+def claim_batch():
+    """Claim up to ``MOMENTS_ML_BATCH_SIZE`` due jobs of the same kind.
+
+    Once a first job is claimed, wait up to ``MOMENTS_ML_BATCH_WAIT`` seconds for the rest
+    of a burst of uploads to be queued, so they share the forward passes.
+    """
+    release_stale_jobs()
+    job = claim_job()
+    if job is None:
+        return []
+    jobs = [job]
+    deadline = time.monotonic() + current_app.config['MOMENTS_ML_BATCH_WAIT']
+    while len(jobs) < current_app.config['MOMENTS_ML_BATCH_SIZE']:
+        job = claim_job(jobs[0].kind)
+        if job is not None:
+            jobs.append(job)
+        elif time.monotonic() < deadline:
+            time.sleep(min(0.1, max(deadline - time.monotonic(), 0)))
+        else:
+            break
+    return jobs
+
+
+def run_jobs(jobs):
+    """Run claimed jobs of one kind, delete them on success.
+
+    If the batch fails, its jobs are run again one by one so a single bad photo only fails its
+    own job, which is then retried with exponential backoff. The results of a job released as
+    stale while it ran are discarded, the run it was given to finishes it.
+    """
+    claims = {job.id: job.started_at for job in jobs}
+    error = None
+    try:
+        job_handlers[jobs[0].kind]([job.photo for job in jobs])
+        finished = db.session.execute(delete(Job).where(claimed_by(claims)))
+        if finished.rowcount == len(claims):
+            db.session.commit()
+            return
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    db.session.rollback()
+
+    jobs = db.session.scalars(select(Job).filter(claimed_by(claims)).order_by(Job.id)).all()
+    if len(jobs) < len(claims):  # released as stale, or the photo was deleted meanwhile
+        lost = sorted(set(claims) - {job.id for job in jobs})
+        current_app.logger.warning(f'Jobs {lost} are no longer held by this run, discarded their results')
+    if error is None:
+        if jobs:
+            run_jobs(jobs)
+        return
+    if len(claims) > 1:
+        current_app.logger.warning(f'Batch of {len(jobs)} jobs failed, retrying one by one: {error}')
+        for job in jobs:
+            run_jobs([job])
+        return
+    for job in jobs:  # none left if the photo was deleted meanwhile
+        job.error = error
+        if job.attempts >= current_app.config['MOMENTS_JOB_MAX_ATTEMPTS']:
+            job.status = 'failed'
+            job.photo.ml_status = 'failed'
+            current_app.logger.error(f'Job {job.id} ({job.kind}) failed: {job.error}')
+        else:
+            delay = current_app.config['MOMENTS_JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.status = 'pending'
+            job.run_at = datetime.now(timezone.utc) + timedelta(seconds=delay)
+            current_app.logger.warning(f'Job {job.id} ({job.kind}) will be retried in {delay}s: {job.error}')
+    db.session.commit()
+
+
+def work(burst=False):
+    """Drain the queue in batches, sleeping ``MOMENTS_WORKER_INTERVAL`` seconds when it is empty.
+
+    With ``burst`` return once nothing is due, instead of waiting for new jobs.
+    """
+    processed = 0
+    while True:
+        jobs = claim_batch()
+        if not jobs:
+            if burst:
+                return processed
+            time.sleep(current_app.config['MOMENTS_WORKER_INTERVAL'])
+            continue
+        run_jobs(jobs)
+        processed += len(jobs)
@@ -0,0 +1,77 @@
+"""
+TorchScript graphs behind the 'exported' inference backend.
+
+Kept apart from ``moments.ml_services`` since defining them imports torch.
+"""
+
+from collections import OrderedDict
+
+import torch
+from transformers.models.yolos.modeling_yolos import YolosObjectDetectionOutput
+
+
+class _VisionEncoder(torch.nn.Module):
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values)[0]
+
+
+class TracedVisionModel(torch.nn.Module):
+    """Stand-in for the BLIP vision encoder running a frozen TorchScript graph.
+
+    The encoder always sees the same square input, so one traced graph serves every image,
+    while caption generation stays in eager mode.
+    """
+
+    def __init__(self, vision_model, image_size, device):
+        super().__init__()
+        example = torch.zeros(1, 3, image_size, image_size, device=device)
+        with torch.no_grad():
+            traced = torch.jit.trace(_VisionEncoder(vision_model).eval(), example, check_trace=False)
+            self.graph = torch.jit.freeze(traced)
+
+    def forward(self, pixel_values, interpolate_pos_encoding=False, **kwargs):
+        return (self.graph(pixel_values),)
+
+
+class _DetectionHead(torch.nn.Module):
+    def __init__(self, detection_model):
+        super().__init__()
+        self.detection_model = detection_model
+
+    def forward(self, pixel_values):
+        outputs = self.detection_model(pixel_values=pixel_values)
+        return outputs.logits, outputs.pred_boxes
+
+
+class TracedDetectionModel:
+    """Run YOLOS through frozen TorchScript graphs, one traced per padded input shape.
+
+    YOLOS interpolates its position embeddings to the input size, which tracing bakes in,
+    so inputs are padded to multiples of ``PAD_MULTIPLE`` to keep the number of graphs small.
+    """
+
+    PAD_MULTIPLE = 64
+
+    def __init__(self, detection_model, max_graphs=8):
+        self.detection_model = detection_model
+        self.max_graphs = max_graphs
+        self.graphs = OrderedDict()
+
+    def __call__(self, pixel_values):
+        shape = tuple(pixel_values.shape[1:])
+        graph = self.graphs.get(shape)
+        if graph is None:
+            with torch.no_grad():
+                graph = torch.jit.freeze(
+                    torch.jit.trace(_DetectionHead(self.detection_model).eval(), pixel_values[:1], check_trace=False)
+                )
+            self.graphs[shape] = graph
+            if len(self.graphs) > self.max_graphs:
+                self.graphs.popitem(last=False)
+        self.graphs.move_to_end(shape)
+        logits, pred_boxes = graph(pixel_values)
+        return YolosObjectDetectionOutput(logits=logits, pred_boxes=pred_boxes)
@@ -0,0 +1,175 @@
+"""
+Local inference server owning the only copy of the ML models.
+
+Run it with ``flask ml-server`` and point the workers at it with ``MOMENTS_ML_SERVER_URL``,
+``MLImageAnalyzer`` then sends its work over localhost HTTP instead of loading the models.
+"""
+
+import base64
+import io
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingAnalyzer:
+    """Merge the images of concurrent requests into shared batches.
+
+    A single thread runs the models: it takes the first waiting request, then keeps adding
+    requests with the same caption profile for up to ``max_wait`` seconds or until ``batch_size``
+    images are collected. Requests for another profile wait for the next batch.
+    """
+
+    def __init__(self, analyzer, batch_size=8, max_wait=0.05):
+        self.analyzer = analyzer
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.deferred = deque()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, images, profile=None, backlog=0):
+        future = Future()
+        self.requests.put((images, profile, backlog, future))
+        return future.result()
+
+    def _next(self, timeout=None):
+        if self.deferred:
+            return self.deferred.popleft()
+        return self.requests.get(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._next()]
+        profile = batch[0][1]
+        count = len(batch[0][0])
+        deferred = deque()
+        while self.deferred and count < self.batch_size:
+            request = self.deferred.popleft()
+            if request[1] == profile:
+                batch.append(request)
+                count += len(request[0])
+            else:
+                deferred.append(request)
+        deferred.extend(self.deferred)
+        self.deferred = deferred
+        deadline = time.monotonic() + self.max_wait
+        while count < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request[1] != profile:
+                self.deferred.append(request)
+                continue
+            batch.append(request)
+            count += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            images = [image for request_images, _, _, _ in batch for image in request_images]
+            # the adaptive profile looks at the longest queue reported by the callers
+            profile = batch[0][1]
+            backlog = max(request_backlog for _, _, request_backlog, _ in batch)
+            try:
+                results = self.analyzer.analyze_batch(
+                    images, batch_size=self.batch_size, profile=profile, backlog=backlog
+                )
+            except Exception as e:
+                for *_, future in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for request_images, _, _, future in batch:
+                future.set_result(results[start : start + len(request_images)])
+                start += len(request_images)
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _upload_file(self, path):
+        """Resolve the path of an image sent by path, only the files under ``upload_path`` are read."""
+        path = Path(path).resolve()
+        if self.server.upload_path is None or not path.is_relative_to(self.server.upload_path):
+            raise ValueError(f'{path} is outside the upload directory')
+        return str(path)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send_json(404, {'message': 'Not found.'})
+        # the load balancer only routes to the server once the models are hot
+        status = self.server.status
+        self._send_json(200 if status == 'ready' else 503, {'status': status})
+
+    def do_POST(self):
+        if self.path != '/analyze':
+            return self._send_json(404, {'message': 'Not found.'})
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            images = [
+                self._upload_file(item['path'])
+                if 'path' in item
+                else Image.open(io.BytesIO(base64.b64decode(item['data'])))
+                for item in payload['images']
+            ]
+            profile = payload.get('profile')
+            backlog = int(payload.get('backlog', 0))
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            return self._send_json(400, {'message': f'Invalid request: {e}'})
+        try:
+            results = self.server.batcher.submit(images, profile, backlog)
+        except Exception as e:
+            logger.exception('Analysis failed')
+            return self._send_json(500, {'message': str(e)})
+        self._send_json(200, {'results': results})
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def _warm_up(server, analyzer):
+    try:
+        analyzer.warm_up()
+    except Exception:
+        logger.exception('Model warm-up failed')
+        server.status = 'failed'
+    else:
+        server.status = 'ready'
+
+
+def create_server(analyzer, host='127.0.0.1', port=5001, batch_size=8, max_wait=0.05, warm_up=False, upload_path=None):
+    """Create the server, with ``warm_up`` the models are loaded in the background and
+    ``GET /health`` answers 503 until they are ready.
+
+    Images sent by path must be under ``upload_path``, without it they must be sent as data.
+    """
+    server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    server.daemon_threads = True
+    server.upload_path = Path(upload_path).resolve() if upload_path is not None else None
+    server.batcher = BatchingAnalyzer(analyzer, batch_size, max_wait)
+    server.status = 'loading' if warm_up else 'ready'
+    if warm_up:
+        threading.Thread(target=_warm_up, args=(server, analyzer), daemon=True).start()
+    return server
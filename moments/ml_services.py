@@ -1,37 +1,107 @@
 """
 ML Services for image analysis and alternative text generation.
 """
+import base64
+import difflib
+import functools
+import io
 import os
+import time
 import logging
-from typing import List, Optional, Dict, Any
+from collections.abc import Sequence
+from typing import Any, Dict, List, NamedTuple, Optional, Union
 from pathlib import Path
 import requests
+from flask import current_app
 from PIL import Image
-import torch
-from transformers import BlipProcessor, BlipForConditionalGeneration, YolosImageProcessor, YolosForObjectDetection
 
 logger = logging.getLogger(__name__)
 
+
+class DecodedImage(NamedTuple):
+    image: Image.Image  # RGB, possibly downscaled while decoding
+    size: tuple[int, int]  # (width, height) of the original
+    name: str
+
+
+class AnalysisError(Exception):
+    """The models could not analyze an image, kept in place of its result inside a batch."""
+
+
 class MLImageAnalyzer:
     """ML service for image analysis including caption generation and object detection."""
+
+    DECODE_SIZE = 512  # largest model input side (YOLOS shortest edge, BLIP uses 384)
+    FALLBACK_CAPTION = "Image description unavailable"
+    CAPTION_MODEL = "Salesforce/blip-image-captioning-base"
+    DETECTION_MODEL = "hustvl/yolos-tiny"
+    # 'fp32': eager PyTorch, 'int8': dynamically quantized linear layers, 'exported': frozen TorchScript graphs
+    BACKENDS = ('fp32', 'int8', 'exported')
+    # caption decoding settings, from the fastest to the best captions
+    CAPTION_PROFILES = {
+        'fast': {"max_length": 30, "num_beams": 1},
+        'balanced': {"max_length": 40, "num_beams": 3},
+        'quality': {"max_length": 50, "num_beams": 5},
+    }
     
-    def __init__(self):
+    def __init__(
+        self,
+        batch_size: int = 8,
+        server_url: Optional[str] = None,
+        server_timeout: float = 60,
+        backend: str = 'fp32',
+        caption_profile: str = 'quality',
+        caption_budget: float = 2.0,
+        backlog_threshold: int = 50,
+        model_dir: Optional[str] = None,
+    ):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown inference backend: {backend}")
+        self.batch_size = batch_size
+        self.backend = backend
+        self.caption_profile = self._check_profile(caption_profile)
+        # the adaptive profile: seconds per image a profile may take, and the queue length that forces 'fast'
+        self.caption_budget = caption_budget
+        self.backlog_threshold = backlog_threshold
+        self.caption_latency = {}  # profile -> moving average of the seconds per image
+        self.traced_detection = None
+        # load the weights from <model_dir>/<model name> instead of the Hugging Face cache
+        self.model_dir = model_dir
+        # client mode: send the work to `flask ml-server`, which owns the only copy of the models
+        self.server_url = server_url.rstrip('/') if server_url else None
+        self.server_timeout = server_timeout
         self.caption_model = None
         self.caption_processor = None
         self.detection_model = None
         self.detection_processor = None
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        logger.info(f"Using device: {self.device}")
+        self._device = None
+
+    @property
+    def device(self) -> str:
+        """Torch device of the models, picked on first use so that importing this module stays cheap."""
+        if self._device is None:
+            import torch
+
+            self._device = "cuda" if torch.cuda.is_available() else "cpu"
+            logger.info(f"Using device: {self._device}")
+        return self._device
     
+    def _model_path(self, model_name: str) -> str:
+        if self.model_dir is None:
+            return model_name
+        return os.path.join(self.model_dir, model_name.split("/")[-1])
+
     def _load_caption_model(self):
         """Load the BLIP model for image captioning."""
         if self.caption_model is None:
             try:
-                model_name = "Salesforce/blip-image-captioning-base"
-                self.caption_processor = BlipProcessor.from_pretrained(model_name)
-                self.caption_model = BlipForConditionalGeneration.from_pretrained(model_name)
-                self.caption_model.to(self.device)
-                logger.info("Caption model loaded successfully")
+                from transformers import BlipForConditionalGeneration, BlipProcessor
+
+                self.caption_processor = BlipProcessor.from_pretrained(self._model_path(self.CAPTION_MODEL))
+                self.caption_model = BlipForConditionalGeneration.from_pretrained(self._model_path(self.CAPTION_MODEL))
+                self.caption_model.to(self.device).eval()
+                self._prepare_caption_model()
+                logger.info(f"Caption model loaded successfully ({self.backend})")
             except Exception as e:
                 logger.error(f"Failed to load caption model: {e}")
                 raise
@@ -40,15 +110,266 @@ class MLImageAnalyzer:
         """Load the YOLOS model for object detection."""
         if self.detection_model is None:
             try:
-                model_name = "hustvl/yolos-tiny"
-                self.detection_processor = YolosImageProcessor.from_pretrained(model_name)
-                self.detection_model = YolosForObjectDetection.from_pretrained(model_name)
-                self.detection_model.to(self.device)
-                logger.info("Detection model loaded successfully")
+                from transformers import YolosForObjectDetection, YolosImageProcessor
+
+                self.detection_processor = YolosImageProcessor.from_pretrained(self._model_path(self.DETECTION_MODEL))
+                self.detection_model = YolosForObjectDetection.from_pretrained(
+                    self._model_path(self.DETECTION_MODEL)
+                )
+                self.detection_model.to(self.device).eval()
+                self._prepare_detection_model()
+                logger.info(f"Detection model loaded successfully ({self.backend})")
             except Exception as e:
                 logger.error(f"Failed to load detection model: {e}")
                 raise
     
+    def warm_up(self) -> float:
+        """
+        Load both models and run one forward pass of each on a blank image, so the first
+        real batch does not pay for loading the weights, allocating buffers or tracing graphs.
+
+        Errors are raised instead of falling back, so the caller knows whether the models are ready.
+
+        Returns:
+            Seconds the warm-up took
+        """
+        start = time.perf_counter()
+        self._load_caption_model()
+        self._load_detection_model()
+        image = Image.new("RGB", (self.DECODE_SIZE, self.DECODE_SIZE))
+        decoded = [DecodedImage(image, image.size, "warm-up")]
+        self._caption_batch(decoded, self.resolve_caption_profile())
+        self._detect_batch(decoded)
+        self.caption_latency.clear()  # the first pass is slower than the ones to come
+        elapsed = time.perf_counter() - start
+        logger.info(f"Models warmed up in {elapsed:.2f}s")
+        return elapsed
+
+    def model_version(self, profile: Optional[str] = None) -> str:
+        """
+        Identify the models and settings producing the results, stored next to cached results.
+
+        Args:
+            profile: Caption profile or 'adaptive', defaults to ``self.caption_profile``
+
+        Returns:
+            Version string, changing whenever the results of an image could change
+        """
+        profile = self._check_profile(profile or self.caption_profile)
+        return f"{self.CAPTION_MODEL}+{self.DETECTION_MODEL}/{self.backend}/{profile}"
+
+    def _check_profile(self, profile: str) -> str:
+        if profile != 'adaptive' and profile not in self.CAPTION_PROFILES:
+            raise ValueError(f"Unknown caption profile: {profile}")
+        return profile
+
+    def resolve_caption_profile(self, profile: Optional[str] = None, backlog: int = 0) -> str:
+        """
+        Turn a profile name, possibly 'adaptive', into one of ``CAPTION_PROFILES``.
+
+        The adaptive profile falls back to 'fast' while ``backlog`` images wait in the queue
+        beyond ``backlog_threshold``, otherwise it picks the best profile whose measured
+        latency fits in ``caption_budget`` seconds per image. A profile not measured yet is
+        tried once.
+
+        Args:
+            profile: Profile name, defaults to ``self.caption_profile``
+            backlog: Number of images waiting to be analyzed after these
+
+        Returns:
+            Name of the profile to decode with
+        """
+        profile = self._check_profile(profile or self.caption_profile)
+        if profile != 'adaptive':
+            return profile
+        if backlog > self.backlog_threshold:
+            return 'fast'
+        for name in ('quality', 'balanced'):
+            latency = self.caption_latency.get(name)
+            if latency is None or latency <= self.caption_budget:
+                return name
+        return 'fast'
+
+    def _record_caption_latency(self, profile: str, seconds: float):
+        previous = self.caption_latency.get(profile)
+        self.caption_latency[profile] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+
+    def _quantize(self, model):
+        if self.device != "cpu":
+            logger.warning("int8 dynamic quantization only runs on CPU, keeping fp32")
+            return model
+        import torch
+
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def _prepare_caption_model(self):
+        if self.backend == 'int8':
+            self.caption_model = self._quantize(self.caption_model)
+        elif self.backend == 'exported':
+            from moments.ml_graphs import TracedVisionModel
+
+            image_size = self.caption_processor.image_processor.size["height"]
+            self.caption_model.vision_model = TracedVisionModel(
+                self.caption_model.vision_model, image_size, self.device
+            )
+
+    def _prepare_detection_model(self):
+        if self.backend == 'int8':
+            self.detection_model = self._quantize(self.detection_model)
+        elif self.backend == 'exported':
+            from moments.ml_graphs import TracedDetectionModel
+
+            self.traced_detection = TracedDetectionModel(self.detection_model)
+
+    def _analyze_remote(
+        self,
+        images: Sequence[Union[str, Image.Image]],
+        batch_size: Optional[int],
+        profile: Optional[str] = None,
+        backlog: int = 0,
+    ) -> Optional[list[dict[str, Any]]]:
+        """Analyze the images on the inference server, return None if it can't answer."""
+        payload = []
+        for image in images:
+            if isinstance(image, Image.Image):
+                buffer = io.BytesIO()
+                image.convert('RGB').save(buffer, 'PNG')
+                payload.append({"data": base64.b64encode(buffer.getvalue()).decode()})
+            else:  # the server runs on the same host, let it read the file itself
+                payload.append({"path": str(Path(image).resolve())})
+        try:
+            response = requests.post(
+                f"{self.server_url}/analyze",
+                json={
+                    "images": payload,
+                    "batch_size": batch_size,
+                    "profile": profile or self.caption_profile,
+                    "backlog": backlog,
+                },
+                timeout=self.server_timeout,
+            )
+            response.raise_for_status()
+            return response.json()["results"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.warning(f"Inference server unavailable, analyzing in-process: {e}")
+            return None
+
+    def decode_image(self, image: Union[str, Image.Image]) -> DecodedImage:
+        """
+        Decode an image once into the RGB buffer shared by both models.
+
+        JPEG files are decoded in draft mode, letting libjpeg downscale by 1/2, 1/4 or 1/8
+        while decoding as long as the result stays at least ``DECODE_SIZE`` on both sides.
+
+        Args:
+            image: Path to the image file or PIL image
+
+        Returns:
+            The RGB image, the size of the original and a name for the logs
+        """
+        if isinstance(image, Image.Image):
+            return DecodedImage(image.convert('RGB'), image.size, 'image')
+        with Image.open(image) as opened:
+            size = opened.size
+            if opened.format == 'JPEG':
+                opened.draft('RGB', (self.DECODE_SIZE, self.DECODE_SIZE))
+            return DecodedImage(opened.convert('RGB'), size, str(image))
+
+    def _decode_all(self, images: Sequence[Union[str, Image.Image]]) -> list[Optional[DecodedImage]]:
+        decoded = []
+        for image in images:
+            try:
+                decoded.append(self.decode_image(image))
+            except Exception as e:
+                logger.error(f"Error decoding {image if isinstance(image, str) else 'image'}: {e}")
+                decoded.append(None)
+        return decoded
+
+    def _batches(self, images: Sequence, batch_size: Optional[int]):
+        batch_size = batch_size or self.batch_size
+        for start in range(0, len(images), batch_size):
+            yield images[start:start + batch_size]
+
+    def _run_batches(self, images: Sequence[DecodedImage], batch_size: Optional[int], run_batch) -> list:
+        """Run ``run_batch`` over each batch, retrying the images of a failed batch one by one.
+
+        A single bad image then only costs its own result, an ``AnalysisError``, instead of the whole batch.
+        """
+        results = []
+        for batch in self._batches(list(images), batch_size):
+            try:
+                results.extend(run_batch(batch))
+            except Exception as e:
+                if len(batch) == 1:
+                    logger.error(f"Error analyzing {batch[0].name}: {e}")
+                    results.append(AnalysisError(f"{type(e).__name__}: {e}"))
+                    continue
+                logger.warning(f"Batch of {len(batch)} images failed, retrying one by one: {e}")
+                results.extend(self._run_batches(batch, 1, run_batch))
+        return results
+
+    def _map_decoded(self, decoded: Sequence[Optional[DecodedImage]], batch_size: Optional[int], run_batch) -> list:
+        """Run ``run_batch`` over the decoded images, with an ``AnalysisError`` for the undecodable ones."""
+        results = [AnalysisError("The image could not be decoded") for _ in decoded]
+        # batch images of similar shape together to keep the padding small
+        order = sorted(
+            (i for i, image in enumerate(decoded) if image is not None),
+            key=lambda i: decoded[i].image.width / decoded[i].image.height,
+        )
+        outputs = self._run_batches([decoded[i] for i in order], batch_size, run_batch)
+        for i, output in zip(order, outputs):
+            results[i] = output
+        return results
+
+    def _caption_batch(self, images: Sequence[DecodedImage], profile: str) -> list[str]:
+        import torch
+
+        # BLIP resizes every image to the same square input, so the batch needs no padding
+        inputs = self.caption_processor(images=[image.image for image in images], return_tensors="pt").to(self.device)
+        start = time.perf_counter()
+        with torch.no_grad():
+            out = self.caption_model.generate(**inputs, **self.CAPTION_PROFILES[profile])
+        self._record_caption_latency(profile, (time.perf_counter() - start) / len(images))
+        return self.caption_processor.batch_decode(out, skip_special_tokens=True)
+
+    def _caption_decoded(
+        self, decoded: Sequence[Optional[DecodedImage]], batch_size: Optional[int], profile: Optional[str], backlog: int
+    ) -> list[str]:
+        try:
+            self._load_caption_model()
+        except Exception as e:
+            return [AnalysisError(f"Caption model unavailable: {e}") for _ in decoded]
+        profile = self.resolve_caption_profile(profile, backlog)
+        run_batch = functools.partial(self._caption_batch, profile=profile)
+        return self._map_decoded(decoded, batch_size, run_batch)
+
+    def generate_alt_texts(
+        self,
+        images: Sequence[Union[str, Image.Image]],
+        batch_size: Optional[int] = None,
+        profile: Optional[str] = None,
+        backlog: int = 0,
+    ) -> list[str]:
+        """
+        Generate alternative text for several images, running BLIP over batches.
+
+        Args:
+            images: Paths of the image files or PIL images
+            batch_size: Maximum number of images per forward pass, defaults to ``self.batch_size``
+            profile: Caption profile or 'adaptive', defaults to ``self.caption_profile``
+            backlog: Number of images waiting after these, used by the adaptive profile
+
+        Returns:
+            Generated alternative texts, in the order of ``images``
+        """
+        if self.server_url:
+            results = self._analyze_remote(images, batch_size, profile, backlog)
+            if results is not None:
+                return [result["alt_text"] for result in results]
+        captions = self._caption_decoded(self._decode_all(images), batch_size, profile, backlog)
+        logger.info(f"Generated captions for {len(images)} images")
+        return [self.FALLBACK_CAPTION if isinstance(caption, AnalysisError) else caption for caption in captions]
+
     def generate_alt_text(self, image_path: str) -> str:
         """
         Generate alternative text for an image using BLIP model.
@@ -59,25 +380,84 @@ class MLImageAnalyzer:
         Returns:
             Generated alternative text
         """
+        return self.generate_alt_texts([image_path])[0]
+
+    def _detect_batch(self, images: Sequence[DecodedImage]) -> list[list[dict[str, Any]]]:
+        import torch
+
+        # YOLOS keeps the aspect ratio, pad every resized image to the largest one of the batch
+        pixel_values = [
+            self.detection_processor(images=image.image, return_tensors="pt")["pixel_values"][0] for image in images
+        ]
+        height = max(values.shape[1] for values in pixel_values)
+        width = max(values.shape[2] for values in pixel_values)
+        if self.traced_detection is not None:
+            multiple = self.traced_detection.PAD_MULTIPLE
+            height, width = -(-height // multiple) * multiple, -(-width // multiple) * multiple
+        batch = torch.zeros(len(pixel_values), 3, height, width)
+        for i, values in enumerate(pixel_values):
+            batch[i, :, :values.shape[1], :values.shape[2]] = values
+
+        with torch.no_grad():
+            if self.traced_detection is not None:
+                outputs = self.traced_detection(batch.to(self.device))
+            else:
+                outputs = self.detection_model(pixel_values=batch.to(self.device))
+
+        # predicted boxes are relative to the padded input, scale them back to each original image
+        target_sizes = torch.tensor([
+            [height * image.size[1] / values.shape[1], width * image.size[0] / values.shape[2]]
+            for image, values in zip(images, pixel_values)
+        ]).to(self.device)
+        results = self.detection_processor.post_process_object_detection(
+            outputs, target_sizes=target_sizes, threshold=0.5
+        )
+
+        detections = []
+        for result in results:
+            detections.append([
+                {
+                    "label": self.detection_model.config.id2label[label.item()],
+                    "confidence": score.item(),
+                    "box": box.tolist()
+                }
+                for score, label, box in zip(result["scores"], result["labels"], result["boxes"])
+            ])
+        return detections
+
+    def _detect_decoded(
+        self, decoded: Sequence[Optional[DecodedImage]], batch_size: Optional[int]
+    ) -> list[list[dict[str, Any]]]:
         try:
-            self._load_caption_model()
-            
-            # Load and process image
-            image = Image.open(image_path).convert('RGB')
-            inputs = self.caption_processor(image, return_tensors="pt").to(self.device)
-            
-            # Generate caption
-            with torch.no_grad():
-                out = self.caption_model.generate(**inputs, max_length=50, num_beams=5)
-            
-            caption = self.caption_processor.decode(out[0], skip_special_tokens=True)
-            logger.info(f"Generated caption for {image_path}: {caption}")
-            return caption
-            
+            self._load_detection_model()
         except Exception as e:
-            logger.error(f"Error generating alt text for {image_path}: {e}")
-            return "Image description unavailable"
-    
+            return [AnalysisError(f"Detection model unavailable: {e}") for _ in decoded]
+        return self._map_decoded(decoded, batch_size, self._detect_batch)
+
+    def detect_objects_batch(
+        self, images: Sequence[Union[str, Image.Image]], batch_size: Optional[int] = None
+    ) -> list[list[dict[str, Any]]]:
+        """
+        Detect objects in several images, running YOLOS over padded batches.
+
+        Args:
+            images: Paths of the image files or PIL images
+            batch_size: Maximum number of images per forward pass, defaults to ``self.batch_size``
+
+        Returns:
+            One list of detected objects per image, in the order of ``images``
+        """
+        if self.server_url:
+            results = self._analyze_remote(images, batch_size)
+            if results is not None:
+                return [result["objects"] for result in results]
+        results = [
+            [] if isinstance(objects, AnalysisError) else objects
+            for objects in self._detect_decoded(self._decode_all(images), batch_size)
+        ]
+        logger.info(f"Detected {sum(len(objects) for objects in results)} objects in {len(images)} images")
+        return results
+
     def detect_objects(self, image_path: str) -> List[Dict[str, Any]]:
         """
         Detect objects in an image using YOLOS model.
@@ -88,38 +468,71 @@ class MLImageAnalyzer:
         Returns:
             List of detected objects with labels and confidence scores
         """
-        try:
-            self._load_detection_model()
-            
-            # Load and process image
-            image = Image.open(image_path).convert('RGB')
-            inputs = self.detection_processor(images=image, return_tensors="pt").to(self.device)
-            
-            # Detect objects
-            with torch.no_grad():
-                outputs = self.detection_model(**inputs)
-            
-            # Process results
-            target_sizes = torch.tensor([image.size[::-1]]).to(self.device)
-            results = self.detection_processor.post_process_object_detection(
-                outputs, target_sizes=target_sizes, threshold=0.5
-            )[0]
-            
-            objects = []
-            for score, label, box in zip(results["scores"], results["labels"], results["boxes"]):
-                objects.append({
-                    "label": self.detection_model.config.id2label[label.item()],
-                    "confidence": score.item(),
-                    "box": box.tolist()
-                })
-            
-            logger.info(f"Detected {len(objects)} objects in {image_path}")
-            return objects
-            
-        except Exception as e:
-            logger.error(f"Error detecting objects in {image_path}: {e}")
-            return []
-    
+        return self.detect_objects_batch([image_path])[0]
+
+    def _keywords(self, caption: str, objects: list[dict[str, Any]]) -> list[str]:
+        keywords = [obj["label"] for obj in objects if obj["confidence"] > 0.5]
+        if caption == self.FALLBACK_CAPTION:
+            return list(set(keywords))
+        # Also add caption words as keywords
+        keywords.extend(word.lower().strip('.,!?') for word in caption.split() if len(word) > 2 and word.isalpha())
+        # Remove duplicates and return
+        return list(set(keywords))
+
+    def analyze_batch(
+        self,
+        images: Sequence[Union[str, Image.Image]],
+        batch_size: Optional[int] = None,
+        profile: Optional[str] = None,
+        backlog: int = 0,
+    ) -> list[dict[str, Any]]:
+        """
+        Caption and detect objects in several images, decoding each of them only once.
+
+        Args:
+            images: Paths of the image files or PIL images
+            batch_size: Maximum number of images per forward pass, defaults to ``self.batch_size``
+            profile: Caption profile or 'adaptive', defaults to ``self.caption_profile``
+            backlog: Number of images waiting after these, used by the adaptive profile
+
+        Returns:
+            One dict per image with ``alt_text``, ``objects``, ``keywords`` and ``error``. When the
+            models failed on an image, ``error`` tells why and the other fields hold the fallbacks.
+        """
+        if self.server_url:
+            results = self._analyze_remote(images, batch_size, profile, backlog)
+            if results is not None:
+                return results
+        decoded = self._decode_all(images)
+        captions = self._caption_decoded(decoded, batch_size, profile, backlog)
+        detections = self._detect_decoded(decoded, batch_size)
+        logger.info(f"Analyzed {len(images)} images")
+        results = []
+        for caption, objects in zip(captions, detections):
+            errors = [output for output in (caption, objects) if isinstance(output, AnalysisError)]
+            errors = list(dict.fromkeys(str(error) for error in errors))  # an undecodable image fails both
+            if errors:
+                caption, objects = self.FALLBACK_CAPTION, []
+            results.append({
+                "alt_text": caption,
+                "objects": objects,
+                "keywords": self._keywords(caption, objects),
+                "error": "; ".join(errors) or None,
+            })
+        return results
+
+    def analyze(self, image: Union[str, Image.Image]) -> dict[str, Any]:
+        """
+        Caption and detect objects in an image, decoding it only once.
+
+        Args:
+            image: Path to the image file or PIL image
+
+        Returns:
+            Dict with ``alt_text``, ``objects`` and ``keywords``
+        """
+        return self.analyze_batch([image])[0]
+
     def get_searchable_keywords(self, image_path: str) -> List[str]:
         """
         Extract searchable keywords from an image.
@@ -130,17 +543,84 @@ class MLImageAnalyzer:
         Returns:
             List of searchable keywords
         """
-        objects = self.detect_objects(image_path)
-        keywords = [obj["label"] for obj in objects if obj["confidence"] > 0.5]
-        
-        # Also add caption words as keywords
-        caption = self.generate_alt_text(image_path)
-        caption_words = [word.lower().strip('.,!?') for word in caption.split() 
-                        if len(word) > 2 and word.isalpha()]
-        keywords.extend(caption_words)
-        
-        # Remove duplicates and return
-        return list(set(keywords))
+        return self.analyze(image_path)["keywords"]
+
+
+def _label_f1(objects: list[dict[str, Any]], baseline: list[dict[str, Any]]) -> float:
+    labels, expected = {obj["label"] for obj in objects}, {obj["label"] for obj in baseline}
+    if not labels and not expected:
+        return 1.0
+    return 2 * len(labels & expected) / (len(labels) + len(expected))
+
+
+def compare_backends(images: Sequence[str], backends: Sequence[str]) -> list[dict[str, Any]]:
+    """
+    Run every backend over the same images and measure it against fp32.
+
+    Args:
+        images: Paths of the image files
+        backends: Backends to compare, fp32 is always run first as the baseline
+
+    Returns:
+        One dict per backend with the mean latency per image in ms, the share of captions
+        identical to fp32, the mean word similarity of the captions and the mean F1 of the
+        detected labels against fp32
+    """
+    rows = []
+    baseline = None
+    for backend in ['fp32'] + [backend for backend in backends if backend != 'fp32']:
+        analyzer = MLImageAnalyzer(backend=backend)
+        analyzer._load_caption_model()
+        analyzer._load_detection_model()
+        analyzer.analyze(images[0])  # warm up, the first call also traces the graphs
+        results = []
+        start = time.perf_counter()
+        for image in images:
+            results.append(analyzer.analyze(image))
+        latency = (time.perf_counter() - start) * 1000 / len(images)
+        baseline = baseline or results
+        pairs = list(zip(results, baseline))
+        rows.append({
+            "backend": backend,
+            "latency": latency,
+            "caption_match": sum(r["alt_text"] == b["alt_text"] for r, b in pairs) / len(pairs),
+            "caption_similarity": sum(
+                difflib.SequenceMatcher(None, r["alt_text"].split(), b["alt_text"].split()).ratio() for r, b in pairs
+            ) / len(pairs),
+            "label_f1": sum(_label_f1(r["objects"], b["objects"]) for r, b in pairs) / len(pairs),
+        })
+    return rows
+
+
+class MLAnalyzer:
+    """Build the ``MLImageAnalyzer`` of the current app from its config and proxy to it.
+
+    Building it is cheap, the models are only loaded by the first analysis or the warm-up.
+    """
+
+    def init_app(self, app):
+        app.extensions['moments_ml_analyzer'] = self.create(app.config, app.config['MOMENTS_ML_SERVER_URL'])
+
+    @staticmethod
+    def create(config, server_url=None):
+        """Build an analyzer from the ``MOMENTS_ML_*`` settings, in-process unless ``server_url`` is given."""
+        return MLImageAnalyzer(
+            batch_size=config['MOMENTS_ML_BATCH_SIZE'],
+            server_url=server_url,
+            backend=config['MOMENTS_ML_BACKEND'],
+            caption_profile=config['MOMENTS_ML_CAPTION_PROFILE'],
+            caption_budget=config['MOMENTS_ML_CAPTION_BUDGET'],
+            backlog_threshold=config['MOMENTS_ML_BACKLOG_THRESHOLD'],
+            model_dir=config['MOMENTS_ML_MODEL_DIR'],
+        )
+
+    @property
+    def analyzer(self):
+        return current_app.extensions['moments_ml_analyzer']
+
+    def __getattr__(self, name):
+        return getattr(self.analyzer, name)
+
 
 # Global instance
-ml_analyzer = MLImageAnalyzer()
\ No newline at end of file
+ml_analyzer = MLAnalyzer()
\ No newline at end of file
@@ -1,14 +1,35 @@
+import json
+from collections import Counter
 from datetime import datetime, timezone
-from typing import Optional
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+from uuid import uuid4
 
-from flask import current_app
+from flask import current_app, g
 from flask_avatars import Identicon
 from flask_login import UserMixin
-from sqlalchemy import Column, ForeignKey, String, Text, event, func, select, engine
-from sqlalchemy.orm import Mapped, WriteOnlyMapped, mapped_column, relationship
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Index,
+    String,
+    Text,
+    delete,
+    engine,
+    event,
+    func,
+    insert,
+    inspect,
+    literal,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.orm import Mapped, Session, WriteOnlyMapped, mapped_column, relationship
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from moments.core.extensions import db, whooshee
+from moments.core.extensions import cache, db, whooshee
+from moments.utils import Thumbnail, alternative_filename
 
 
 role_permission = db.Table(
@@ -34,6 +55,18 @@ class Permission(db.Model):
         return f'Permission {self.id}: {self.name}'
 
 
+class PermissionTable(NamedTuple):
+    """Immutable snapshot of the role/permission mapping, one bit per permission."""
+
+    bits: MappingProxyType  # permission name -> bit
+    masks: MappingProxyType  # role id -> bitmask of its permissions
+    version: Optional[str]  # the stamp in the shared cache when it was loaded
+
+    def allows(self, role_id, permission_name):
+        bit = self.bits.get(permission_name, 0)
+        return bit != 0 and self.masks.get(role_id, 0) & bit == bit
+
+
 class Role(db.Model):
     __tablename__ = 'role'
 
@@ -47,6 +80,40 @@ class Role(db.Model):
         passive_deletes=True
     )
 
+    PERMISSION_VERSION_KEY = 'permission-version'
+    _permission_table = None  # loaded once per process, see get_permission_table()
+
+    @staticmethod
+    def get_permission_table():
+        """Return the cached role/permission mapping, loading it on first use.
+
+        The mapping is reloaded when the version stamp in the shared cache moves, which is checked
+        once per app context, so a change committed by another process (e.g. ``flask init-app``)
+        reaches every worker when ``MOMENTS_CACHE_BACKEND`` is shared.
+        """
+        if 'permission_version' not in g:
+            g.permission_version = cache.get(Role.PERMISSION_VERSION_KEY)
+        if Role._permission_table is None or Role._permission_table.version != g.permission_version:
+            names = db.session.scalars(select(Permission.name).order_by(Permission.id)).all()
+            bits = {name: 1 << i for i, name in enumerate(names)}
+            masks = {}
+            stmt = select(role_permission.c.role_id, Permission.name).join(
+                Permission, Permission.id == role_permission.c.permission_id
+            )
+            for role_id, name in db.session.execute(stmt):
+                masks[role_id] = masks.get(role_id, 0) | bits[name]
+            Role._permission_table = PermissionTable(
+                MappingProxyType(bits), MappingProxyType(masks), g.permission_version
+            )
+        return Role._permission_table
+
+    @staticmethod
+    def invalidate_permission_table():
+        """Drop the mapping of this process and move the version stamp so the others reload theirs."""
+        Role._permission_table = None
+        g.permission_version = uuid4().hex
+        cache.set(Role.PERMISSION_VERSION_KEY, g.permission_version, timeout=0)
+
     @staticmethod
     def init_role():
         permissions_by_role  = {
@@ -69,6 +136,7 @@ class Role(db.Model):
                     db.session.add(permission)
                 role.permissions.append(permission)
         db.session.commit()
+        Role.invalidate_permission_table()
 
     def __repr__(self):
         return f'Role {self.id}: {self.name}'
@@ -126,6 +194,12 @@ class User(db.Model, UserMixin):
     receive_comment_notification: Mapped[bool] = mapped_column(default=True)
     receive_follow_notification: Mapped[bool] = mapped_column(default=True)
     receive_collect_notification: Mapped[bool] = mapped_column(default=True)
+    followers_count: Mapped[int] = mapped_column(default=0, server_default='0')  # excludes the self follow
+    following_count: Mapped[int] = mapped_column(default=0, server_default='0')  # excludes the self follow
+    photos_count: Mapped[int] = mapped_column(default=0, server_default='0')
+    collections_count: Mapped[int] = mapped_column(default=0, server_default='0')
+    # set once the followers pass MOMENTS_TIMELINE_PULL_THRESHOLD, the photos are then merged at read time for good
+    timeline_pulled: Mapped[bool] = mapped_column(default=False, server_default='0')
 
     role_id: Mapped[Optional[int]] = mapped_column(ForeignKey('role.id'))
 
@@ -176,12 +250,33 @@ class User(db.Model, UserMixin):
             follow = Follow(follower=self, followed=user)
             db.session.add(follow)
             db.session.commit()
+            Timeline.backfill(follower=self, followed=user)
 
     def unfollow(self, user):
         follow = db.session.scalar(self.following.select().filter_by(followed_id=user.id))
         if follow:
             db.session.delete(follow)
             db.session.commit()
+            Timeline.prune(follower=self, followed=user)
+
+    def get_timeline(self):
+        """Build the home feed statement from the materialized timeline.
+
+        Photos of authors who ever had more followers than ``MOMENTS_TIMELINE_PULL_THRESHOLD``
+        are not fanned out on upload, they are merged in at read time instead.
+        Returns the statement and the keys it should be ordered (and paginated) by.
+        """
+        pulled_author_ids = db.session.scalars(
+            select(User.id)
+            .join(Follow, Follow.followed_id == User.id)
+            .filter(Follow.follower_id == self.id, User.timeline_pulled)
+        ).all()
+        if not pulled_author_ids:
+            stmt = select(Photo).join(Timeline, Timeline.photo_id == Photo.id).filter(Timeline.user_id == self.id)
+            return stmt, (Timeline.created_at, Timeline.photo_id)
+        pushed_photo_ids = select(Timeline.photo_id).filter_by(user_id=self.id)
+        stmt = select(Photo).filter(or_(Photo.id.in_(pushed_photo_ids), Photo.author_id.in_(pulled_author_ids)))
+        return stmt, (Photo.created_at, Photo.id)
 
     def is_following(self, user):
         if user.id is None:  # user.id will be None when follow self
@@ -243,30 +338,16 @@ class User(db.Model, UserMixin):
         return self.active
 
     def can(self, permission_name):
-        permission = db.session.scalar(select(Permission).filter_by(name=permission_name))
-        return permission is not None and self.role is not None and permission in self.role.permissions
-
-    @property
-    def followers_count(self):
-        stmt = self.followers.select().with_only_columns(func.count())
-        return db.session.scalar(stmt) - 1  # minus user self
-
-    @property
-    def following_count(self):
-        stmt = self.following.select().with_only_columns(func.count())
-        return db.session.scalar(stmt) - 1  # minus user self
-
-    @property
-    def photos_count(self):
-        return db.session.scalar(select(func.count(Photo.id)).filter_by(author_id=self.id))
-
-    @property
-    def collections_count(self):
-        return db.session.scalar(select(func.count(Collection.user_id)).filter_by(photo_id=self.id))
+        return Role.get_permission_table().allows(self.role_id, permission_name)
 
     @property
     def notifications_count(self):
-        return db.session.scalar(select(func.count(Notification.id)).filter_by(receiver_id=self.id, is_read=False))
+        key = Notification.unread_count_key(self.id)
+        count = cache.get(key)
+        if count is None:
+            count = db.session.scalar(select(func.count(Notification.id)).filter_by(receiver_id=self.id, is_read=False))
+            cache.set(key, count)
+        return count
 
     def __repr__(self):
         return f'User {self.id}: {self.username}'
@@ -282,6 +363,7 @@ photo_tag = db.Table(
 @whooshee.register_model('description', 'alt_text', 'detected_objects')
 class Photo(db.Model):
     __tablename__ = 'photo'
+    __table_args__ = (Index('ix_photo_collectors_count_id', 'collectors_count', 'id'),)  # tag pages by collections
 
     id: Mapped[int] = mapped_column(primary_key=True)
     description: Mapped[Optional[str]] = mapped_column(String(500))
@@ -290,9 +372,19 @@ class Photo(db.Model):
     filename: Mapped[str] = mapped_column(String(64))
     filename_s: Mapped[str] = mapped_column(String(64))
     filename_m: Mapped[str] = mapped_column(String(64))
+    image_formats: Mapped[Optional[str]] = mapped_column(String(32))  # comma separated alternatives, e.g. 'avif,webp'
+    thumbnails: Mapped[Optional[str]] = mapped_column(Text)  # JSON list of [filename, width, height], by width
+    width: Mapped[Optional[int]]  # of the original, None until the thumbnails are created
+    height: Mapped[Optional[int]]
+    placeholder: Mapped[Optional[str]] = mapped_column(Text)  # data URI of a tiny JPEG, see create_placeholder
     created_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(timezone.utc), index=True)
     can_comment: Mapped[bool] = mapped_column(default=True)
     flag: Mapped[int] = mapped_column(default=0)
+    collectors_count: Mapped[int] = mapped_column(default=0, server_default='0')
+    comments_count: Mapped[int] = mapped_column(default=0, server_default='0')
+    ml_status: Mapped[Optional[str]] = mapped_column(String(16))  # 'pending', 'done' or 'failed', None if never queued
+    ml_analyzed_at: Mapped[Optional[datetime]]
+    ml_version: Mapped[Optional[str]] = mapped_column(String(255))  # MLImageAnalyzer.model_version() of the analysis
 
     author_id: Mapped[int] = mapped_column(ForeignKey('user.id', ondelete='CASCADE'))
 
@@ -305,14 +397,6 @@ class Photo(db.Model):
     )
     tags: Mapped[list['Tag']] = relationship(secondary=photo_tag, back_populates='photos', passive_deletes=True)
 
-    @property
-    def collectors_count(self):
-        return db.session.scalar(select(func.count(Collection.user_id)).filter_by(photo_id=self.id))
-
-    @property
-    def comments_count(self):
-        return db.session.scalar(select(func.count(Comment.id)).filter_by(photo_id=self.id))
-
     def get_detected_objects_list(self):
         """Parse detected objects JSON string into a list."""
         if not self.detected_objects:
@@ -323,6 +407,12 @@ class Photo(db.Model):
         except (json.JSONDecodeError, TypeError):
             return []
 
+    def get_thumbnails(self):
+        """Return the thumbnails for srcset, from the narrowest, empty until they are created."""
+        if not self.thumbnails:
+            return []
+        return [Thumbnail(*thumbnail) for thumbnail in json.loads(self.thumbnails)]
+
     def set_detected_objects(self, objects_list):
         """Set detected objects from a list."""
         import json
@@ -343,23 +433,193 @@ class Photo(db.Model):
         return f'Photo {self.id}: {self.filename}'
 
 
+class RankedTag(NamedTuple):
+    id: int
+    name: str
+    photos_count: int
+
+
 @whooshee.register_model('name')
 class Tag(db.Model):
     __tablename__ = 'tag'
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(64), index=True, unique=True)
+    photos_count: Mapped[int] = mapped_column(default=0, server_default='0', index=True)
 
     photos: WriteOnlyMapped['Photo'] = relationship(secondary=photo_tag, back_populates='tags', passive_deletes=True)
 
-    @property
-    def photos_count(self):
-        return db.session.scalar(select(func.count(photo_tag.c.photo_id)).filter_by(tag_id=self.id))
+    HOT_TAGS_KEY = 'tags:hot'
+
+    @staticmethod
+    def get_hot_tags():
+        """Return the most used tags from the cached ranking, loading it from the counter column on a miss."""
+        number = current_app.config['MOMENTS_HOT_TAG_NUMBER']
+        ranking = cache.get(Tag.HOT_TAGS_KEY)
+        if ranking is None:
+            ranking = Tag.load_ranking(number * 2)
+            cache.set(Tag.HOT_TAGS_KEY, ranking)
+        return [RankedTag(*tag) for tag in ranking['tags'][:number]]
+
+    @staticmethod
+    def load_ranking(size):
+        """Read the top ``size`` tags, the extra ones past the sidebar absorb later changes.
+
+        ``floor`` is the highest count a tag left out of the ranking may have, the ranking
+        stays usable as long as the sidebar part of it does not drop below that.
+        """
+        stmt = (
+            select(Tag.id, Tag.name, Tag.photos_count)
+            .filter(Tag.photos_count > 0)
+            .order_by(Tag.photos_count.desc(), Tag.id)
+            .limit(size)
+        )
+        tags = [list(row) for row in db.session.execute(stmt)]
+        floor = tags[-1][2] if len(tags) == size else 0
+        return {'size': size, 'floor': floor, 'tags': tags}
+
+    @staticmethod
+    def update_ranking(changes):
+        """Merge the committed ``{tag_id: (name, photos_count) or None}`` changes into the cached ranking."""
+        ranking = cache.get(Tag.HOT_TAGS_KEY)
+        if ranking is None:
+            return
+        tags = {tag[0]: tag for tag in ranking['tags']}
+        for tag_id, value in changes.items():
+            if value is None or value[1] <= 0:
+                tags.pop(tag_id, None)
+            else:
+                tags[tag_id] = [tag_id, *value]
+        tags = sorted(tags.values(), key=lambda tag: (-tag[2], tag[0]))
+        size, floor = ranking['size'], ranking['floor']
+        floor = max([floor] + [tag[2] for tag in tags[size:]])
+        tags = tags[:size]
+        number = current_app.config['MOMENTS_HOT_TAG_NUMBER']
+        if floor and (len(tags) < number or tags[number - 1][2] < floor):
+            # a tag outside the ranking may have overtaken the sidebar, read it again next time
+            cache.delete(Tag.HOT_TAGS_KEY)
+        else:
+            cache.set(Tag.HOT_TAGS_KEY, {'size': size, 'floor': floor, 'tags': tags})
 
     def __repr__(self):
         return f'Tag {self.id}: {self.name}'
 
 
+class Job(db.Model):
+    """Background work on a photo, queued by the request and run by ``flask worker``.
+
+    Finished jobs are deleted, so the table only holds the pending, running and failed ones.
+    """
+
+    __tablename__ = 'job'
+    __table_args__ = (Index('ix_job_status_run_at', 'status', 'run_at'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(String(32))
+    status: Mapped[str] = mapped_column(String(16), default='pending')  # 'pending', 'running' or 'failed'
+    attempts: Mapped[int] = mapped_column(default=0)
+    error: Mapped[Optional[str]] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(timezone.utc))
+    run_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(timezone.utc))
+    started_at: Mapped[Optional[datetime]]
+
+    photo_id: Mapped[int] = mapped_column(ForeignKey('photo.id', ondelete='CASCADE'), index=True)
+    photo: Mapped['Photo'] = relationship()
+
+    def __repr__(self):
+        return f'Job {self.id}: {self.kind}'
+
+
+class AnalysisResult(db.Model):
+    """ML analysis of an image content, keyed by the SHA-256 of the file and the model version.
+
+    Identical uploads reuse the stored result instead of running the models again.
+    """
+
+    __tablename__ = 'analysis_result'
+    __table_args__ = (Index('ix_analysis_result_sha256_version', 'sha256', 'model_version', unique=True),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    sha256: Mapped[str] = mapped_column(String(64))
+    model_version: Mapped[str] = mapped_column(String(255))
+    alt_text: Mapped[str] = mapped_column(String(500))
+    objects: Mapped[str] = mapped_column(Text)  # JSON string of detected objects
+    inference_time: Mapped[float]  # seconds the analysis took, saved by every hit
+    hits: Mapped[int] = mapped_column(default=0)
+    created_at: Mapped[datetime] = mapped_column(default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f'AnalysisResult {self.id}: {self.sha256[:12]}'
+
+
+class Timeline(db.Model):
+    """Materialized home feed, one row per (follower, photo) pushed at upload time."""
+
+    __tablename__ = 'timeline'
+    __table_args__ = (Index('ix_timeline_user_id_created_at', 'user_id', 'created_at'),)
+
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    photo_id: Mapped[int] = mapped_column(ForeignKey('photo.id', ondelete='CASCADE'), primary_key=True)
+    author_id: Mapped[int] = mapped_column(ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    created_at: Mapped[datetime]
+
+    @staticmethod
+    def is_pulled(author_id, connection=None):
+        """Return True if the author's photos are merged at read time instead of fanned out.
+
+        The flag is sticky: the photos uploaded while an author was pulled were never fanned out,
+        so dropping back under the threshold must not take them out of the feeds.
+        """
+        return (connection or db.session).scalar(select(User.timeline_pulled).filter_by(id=author_id))
+
+    @staticmethod
+    def push(photo, connection):
+        """Insert the photo into the timeline of every follower of its author."""
+        if Timeline.is_pulled(photo.author_id, connection):
+            return
+        stmt = insert(Timeline.__table__).from_select(
+            ['user_id', 'photo_id', 'author_id', 'created_at'],
+            select(Follow.follower_id, literal(photo.id), literal(photo.author_id), literal(photo.created_at)).filter(
+                Follow.followed_id == photo.author_id
+            ),
+        )
+        connection.execute(stmt)
+
+    @staticmethod
+    def backfill(follower, followed):
+        """Copy the photos of a newly followed user into the follower's timeline."""
+        if Timeline.is_pulled(followed.id):
+            return
+        existing = select(Timeline.photo_id).filter_by(user_id=follower.id, author_id=followed.id)
+        stmt = insert(Timeline).from_select(
+            ['user_id', 'photo_id', 'author_id', 'created_at'],
+            select(literal(follower.id), Photo.id, Photo.author_id, Photo.created_at).filter(
+                Photo.author_id == followed.id, Photo.id.not_in(existing)
+            ),
+        )
+        db.session.execute(stmt)
+        db.session.commit()
+
+    @staticmethod
+    def prune(follower, followed):
+        """Remove the photos of an unfollowed user from the follower's timeline."""
+        db.session.execute(delete(Timeline).filter_by(user_id=follower.id, author_id=followed.id))
+        db.session.commit()
+
+    @staticmethod
+    def rebuild():
+        """Rebuild every timeline from the follow graph, pulling the authors over the threshold."""
+        threshold = current_app.config['MOMENTS_TIMELINE_PULL_THRESHOLD']
+        db.session.execute(update(User).values(timeline_pulled=User.followers_count > threshold))
+        db.session.execute(delete(Timeline))
+        db.session.commit()
+        for follow in db.session.scalars(select(Follow)):
+            Timeline.backfill(follower=follow.follower, followed=follow.followed)
+
+    def __repr__(self):
+        return f'Timeline: user_id={self.user_id}, photo_id={self.photo_id}'
+
+
 class Comment(db.Model):
     __tablename__ = 'comment'
 
@@ -370,7 +630,7 @@ class Comment(db.Model):
 
     replied_id: Mapped[Optional[int]] = mapped_column(ForeignKey('comment.id', ondelete='CASCADE'))
     author_id: Mapped[int] = mapped_column(ForeignKey('user.id', ondelete='CASCADE'))
-    photo_id: Mapped[int] = mapped_column(ForeignKey('photo.id', ondelete='CASCADE'))
+    photo_id: Mapped[int] = mapped_column(ForeignKey('photo.id', ondelete='CASCADE'), index=True)
 
     photo: Mapped['Photo'] = relationship(back_populates='comments')
     author: Mapped['User'] = relationship(back_populates='comments')
@@ -395,6 +655,14 @@ class Notification(db.Model):
 
     receiver: Mapped['User'] = relationship(back_populates='notifications')
 
+    @staticmethod
+    def unread_count_key(receiver_id):
+        return f'notifications:unread:{receiver_id}'
+
+    @staticmethod
+    def stream_channel(receiver_id):
+        return f'notifications:{receiver_id}'
+
     def __repr__(self):
         return f'Notification {self.id}: {self.message}'
 
@@ -420,10 +688,236 @@ def delete_avatars(**kwargs):
                 path.unlink()
 
 
+@event.listens_for(Photo, 'after_insert', named=True)
+def push_timeline(**kwargs):
+    Timeline.push(kwargs['target'], kwargs['connection'])
+
+
 @event.listens_for(Photo, 'after_delete', named=True)
 def delete_photos(**kwargs):
     target = kwargs['target']
-    for filename in [target.filename, target.filename_s, target.filename_m]:
+    images = {target.filename, target.filename_s, target.filename_m}
+    images.update(thumbnail.filename for thumbnail in target.get_thumbnails())
+    filenames = set(images)
+    for fmt in target.image_formats.split(',') if target.image_formats else []:
+        filenames.update(alternative_filename(filename, fmt) for filename in images)
+    for filename in filenames:
         path = current_app.config['MOMENTS_UPLOAD_PATH'] / filename
         if path.exists():  # not every filename map a unique file
             path.unlink()
+
+
+# keep the denormalized counters in step with the rows they count, inside the same transaction
+def update_counter(connection, model, column, delta, *criteria):
+    table = model.__table__
+    connection.execute(update(table).where(*criteria).values({column: table.c[column] + delta}))
+
+
+def update_follow_counts(connection, follow, delta):
+    if follow.follower_id == follow.followed_id:  # the self follow is not counted
+        return
+    update_counter(connection, User, 'following_count', delta, User.id == follow.follower_id)
+    update_counter(connection, User, 'followers_count', delta, User.id == follow.followed_id)
+    if delta > 0:  # crossing the pull threshold upwards, see Timeline.is_pulled()
+        threshold = current_app.config['MOMENTS_TIMELINE_PULL_THRESHOLD']
+        connection.execute(
+            update(User.__table__)
+            .where(User.id == follow.followed_id, User.followers_count > threshold)
+            .values(timeline_pulled=True)
+        )
+
+
+@event.listens_for(Follow, 'after_insert', named=True)
+def increase_follow_counts(**kwargs):
+    update_follow_counts(kwargs['connection'], kwargs['target'], 1)
+
+
+@event.listens_for(Follow, 'after_delete', named=True)
+def decrease_follow_counts(**kwargs):
+    update_follow_counts(kwargs['connection'], kwargs['target'], -1)
+
+
+def update_collection_counts(connection, collection, delta):
+    update_counter(connection, Photo, 'collectors_count', delta, Photo.id == collection.photo_id)
+    update_counter(connection, User, 'collections_count', delta, User.id == collection.user_id)
+
+
+@event.listens_for(Collection, 'after_insert', named=True)
+def increase_collection_counts(**kwargs):
+    update_collection_counts(kwargs['connection'], kwargs['target'], 1)
+
+
+@event.listens_for(Collection, 'after_delete', named=True)
+def decrease_collection_counts(**kwargs):
+    update_collection_counts(kwargs['connection'], kwargs['target'], -1)
+
+
+@event.listens_for(Comment, 'after_insert', named=True)
+def increase_comments_count(**kwargs):
+    update_counter(kwargs['connection'], Photo, 'comments_count', 1, Photo.id == kwargs['target'].photo_id)
+
+
+def recount_comments(connection, *criteria):
+    count = select(func.count(Comment.id)).filter(Comment.photo_id == Photo.id).scalar_subquery()
+    connection.execute(update(Photo.__table__).where(*criteria).values(comments_count=count))
+
+
+@event.listens_for(Comment, 'after_delete', named=True)
+def decrease_comments_count(**kwargs):
+    # replies are removed by the database cascade, so count what is left instead of decrementing
+    recount_comments(kwargs['connection'], Photo.id == kwargs['target'].photo_id)
+
+
+@event.listens_for(Photo, 'after_insert', named=True)
+def increase_photos_count(**kwargs):
+    update_counter(kwargs['connection'], User, 'photos_count', 1, User.id == kwargs['target'].author_id)
+
+
+@event.listens_for(Photo, 'before_delete', named=True)
+def decrease_photo_relation_counts(**kwargs):
+    connection, photo_id = kwargs['connection'], kwargs['target'].id
+    tag_ids = select(photo_tag.c.tag_id).filter_by(photo_id=photo_id)
+    update_counter(connection, Tag, 'photos_count', -1, Tag.id.in_(tag_ids))
+    track_tag_counts(inspect(kwargs['target']).session, connection, tag_ids)
+    collector_ids = select(Collection.user_id).filter_by(photo_id=photo_id)
+    update_counter(connection, User, 'collections_count', -1, User.id.in_(collector_ids))
+
+
+@event.listens_for(Photo, 'after_delete', named=True)
+def decrease_photos_count(**kwargs):
+    update_counter(kwargs['connection'], User, 'photos_count', -1, User.id == kwargs['target'].author_id)
+
+
+@event.listens_for(User, 'before_delete', named=True)
+def decrease_user_relation_counts(**kwargs):
+    connection, user_id = kwargs['connection'], kwargs['target'].id
+    follower_ids = select(Follow.follower_id).filter(Follow.followed_id == user_id, Follow.follower_id != user_id)
+    update_counter(connection, User, 'following_count', -1, User.id.in_(follower_ids))
+    followed_ids = select(Follow.followed_id).filter(Follow.follower_id == user_id, Follow.followed_id != user_id)
+    update_counter(connection, User, 'followers_count', -1, User.id.in_(followed_ids))
+    collected_ids = select(Collection.photo_id).filter_by(user_id=user_id)
+    update_counter(connection, Photo, 'collectors_count', -1, Photo.id.in_(collected_ids))
+    # the user's photos are removed by the database cascade, take their tags and collectors with them
+    tagged = select(photo_tag.c.tag_id).join(Photo, Photo.id == photo_tag.c.photo_id).filter(Photo.author_id == user_id)
+    tagged_count = tagged.filter(photo_tag.c.tag_id == Tag.id).with_only_columns(func.count()).scalar_subquery()
+    update_counter(connection, Tag, 'photos_count', -tagged_count, Tag.id.in_(tagged))
+    track_tag_counts(inspect(kwargs['target']).session, connection, tagged)
+    collectors = (
+        select(Collection.user_id).join(Photo, Photo.id == Collection.photo_id).filter(Photo.author_id == user_id)
+    )
+    collected_count = collectors.filter(Collection.user_id == User.id).with_only_columns(func.count()).scalar_subquery()
+    update_counter(connection, User, 'collections_count', -collected_count, User.id.in_(collectors))
+    # replies always belong to the same photo, so only the commented photos need a recount
+    commented_ids = connection.scalars(select(Comment.photo_id).filter_by(author_id=user_id).distinct()).all()
+    connection.execute(delete(Comment.__table__).where(Comment.author_id == user_id))
+    recount_comments(connection, Photo.id.in_(commented_ids))
+
+
+# unread notification counters are cached, apply the changes once they are committed
+def track_unread_count(notification, delta):
+    session = inspect(notification).session
+    session.info.setdefault('unread_deltas', Counter())[notification.receiver_id] += delta
+
+
+@event.listens_for(Notification, 'after_insert', named=True)
+def increase_unread_count(**kwargs):
+    if not kwargs['target'].is_read:
+        track_unread_count(kwargs['target'], 1)
+
+
+@event.listens_for(Notification, 'after_update', named=True)
+def update_unread_count(**kwargs):
+    target = kwargs['target']
+    history = inspect(target).attrs.is_read.history
+    if history.has_changes():
+        track_unread_count(target, -1 if target.is_read else 1)
+
+
+@event.listens_for(Notification, 'after_delete', named=True)
+def decrease_unread_count(**kwargs):
+    if not kwargs['target'].is_read:
+        track_unread_count(kwargs['target'], -1)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_unread_counts(session):
+    for receiver_id, delta in session.info.pop('unread_deltas', {}).items():
+        if delta:
+            cache.incr(Notification.unread_count_key(receiver_id), delta)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_unread_counts(session, previous_transaction):
+    session.info.pop('unread_deltas', None)
+
+
+# the role/permission mapping is cached by every process, move its version stamp once a change is committed
+def changes_permissions(obj, session):
+    if obj in session.new or obj in session.deleted:
+        return True
+    # a Role is also dirtied by the role.users back-populate of a user change, which does not count
+    attrs = inspect(obj).attrs
+    changed = [attrs.name, attrs.permissions if isinstance(obj, Role) else attrs.roles]
+    return any(attr.history.has_changes() for attr in changed)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_permission_changes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Role, Permission)) and changes_permissions(obj, session):
+            session.info['permissions_changed'] = True
+            return
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_permission_table(session):
+    if session.info.pop('permissions_changed', False):
+        Role.invalidate_permission_table()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_permission_changes(session, previous_transaction):
+    session.info.pop('permissions_changed', None)
+
+
+@event.listens_for(Session, 'after_flush')
+def update_tag_photos_count(session, flush_context):
+    deltas = Counter()
+    for photo in list(session.new) + list(session.dirty):
+        if not isinstance(photo, Photo):
+            continue
+        history = inspect(photo).attrs.tags.history
+        for tag in history.added:
+            deltas[tag.id] += 1
+        for tag in history.deleted:
+            deltas[tag.id] -= 1
+    tag_ids = [tag_id for tag_id, delta in deltas.items() if delta]
+    for tag_id in tag_ids:
+        update_counter(session.connection(), Tag, 'photos_count', deltas[tag_id], Tag.id == tag_id)
+    if tag_ids:
+        track_tag_counts(session, session.connection(), tag_ids)
+
+
+# the hot tags ranking is cached, merge the new counts of the touched tags once they are committed
+def track_tag_counts(session, connection, tag_ids):
+    stmt = select(Tag.id, Tag.name, Tag.photos_count).filter(Tag.id.in_(tag_ids))
+    changes = session.info.setdefault('tag_counts', {})
+    for tag_id, name, photos_count in connection.execute(stmt):
+        changes[tag_id] = (name, photos_count)
+
+
+@event.listens_for(Tag, 'after_delete', named=True)
+def remove_ranked_tag(**kwargs):
+    inspect(kwargs['target']).session.info.setdefault('tag_counts', {})[kwargs['target'].id] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_tag_counts(session):
+    changes = session.info.pop('tag_counts', None)
+    if changes:
+        Tag.update_ranking(changes)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_tag_counts(session, previous_transaction):
+    session.info.pop('tag_counts', None)
@@ -1,6 +1,6 @@
 from flask import url_for
 
-from moments.core.extensions import db
+from moments.core.extensions import broker, db
 from moments.models import Notification
 
 
@@ -12,6 +12,7 @@ def push_follow_notification(follower, receiver):
     notification = Notification(message=message, receiver=receiver)
     db.session.add(notification)
     db.session.commit()
+    publish_notification(notification)
 
 
 def push_comment_notification(photo_id, receiver, page=1):
@@ -22,6 +23,7 @@ def push_comment_notification(photo_id, receiver, page=1):
     notification = Notification(message=message, receiver=receiver)
     db.session.add(notification)
     db.session.commit()
+    publish_notification(notification)
 
 
 def push_collect_notification(user, photo_id, receiver):
@@ -33,3 +35,20 @@ def push_collect_notification(user, photo_id, receiver):
     notification = Notification(message=message, receiver=receiver)
     db.session.add(notification)
     db.session.commit()
+    publish_notification(notification)
+
+
+def publish_notifications_count(receiver):
+    """Tell the open notification streams of ``receiver`` about the new unread count."""
+    broker.publish(
+        Notification.stream_channel(receiver.id),
+        {'event': 'count', 'data': {'count': receiver.notifications_count}},
+    )
+
+
+def publish_notification(notification):
+    receiver = notification.receiver
+    broker.publish(
+        Notification.stream_channel(receiver.id),
+        {'event': 'notification', 'data': {'count': receiver.notifications_count, 'message': notification.message}},
+    )
@@ -0,0 +1,103 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request, url_for
+from sqlalchemy import and_, or_
+
+from moments.core.extensions import db
+
+
+class CursorPagination:
+    """Keyset pagination over a statement ordered by ``keys`` (descending).
+
+    Unlike ``db.paginate``, it never runs a ``COUNT(*)`` and never uses ``OFFSET``, the position
+    is carried by an opaque cursor encoding the key values of the first or last row of a page.
+    The last key must be unique (usually the primary key) to break ties.
+    """
+
+    total = None
+    pages = None
+
+    def __init__(self, stmt, keys, per_page, cursor=None):
+        self.keys = keys
+        self.per_page = per_page
+        direction, values = self.decode_cursor(cursor) if cursor else ('next', None)
+        backwards = direction == 'prev'
+
+        if values is not None:
+            stmt = stmt.filter(self._after(values, backwards))
+        order = [key.asc() if backwards else key.desc() for key in keys]
+        stmt = stmt.add_columns(*keys).order_by(None).order_by(*order).limit(per_page + 1)
+        rows = db.session.execute(stmt).all()
+
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+        self.items = [row[0] for row in rows]
+        self.has_next = True if backwards else has_more
+        self.has_prev = has_more if backwards else values is not None
+        self.next_cursor = self.encode_cursor('next', rows[-1][1:]) if self.has_next and rows else None
+        self.prev_cursor = self.encode_cursor('prev', rows[0][1:]) if self.has_prev and rows else None
+
+    def _after(self, values, backwards):
+        """Build ``(k1, k2, ...) < (v1, v2, ...)`` (or ``>``) without relying on row-value support."""
+        clauses = []
+        for i, key in enumerate(self.keys):
+            compare = key > values[i] if backwards else key < values[i]
+            clauses.append(and_(*[self.keys[j] == values[j] for j in range(i)], compare))
+        return or_(*clauses)
+
+    def encode_cursor(self, direction, values):
+        payload = json.dumps([direction, [v.isoformat() if isinstance(v, datetime) else v for v in values]])
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            direction, values = json.loads(payload)
+            if direction not in ('next', 'prev') or len(values) != len(self.keys):
+                raise ValueError(cursor)
+            values = [self.decode_value(key, value) for key, value in zip(self.keys, values)]
+        except (binascii.Error, ValueError, TypeError):
+            abort(400, description='Invalid page cursor.')
+        return direction, values
+
+    @staticmethod
+    def decode_value(key, value):
+        """Check a cursor value against the type of its key, a tampered cursor never reaches the query."""
+        python_type = key.type.python_type
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if isinstance(value, bool) or not isinstance(value, python_type):
+            raise TypeError(value)
+        return value
+
+    def _url_for(self, cursor):
+        args = request.args.to_dict()
+        args.pop('page', None)
+        args['cursor'] = cursor
+        return url_for(request.endpoint, **request.view_args, **args)
+
+    @property
+    def prev_url(self):
+        return self._url_for(self.prev_cursor) if self.prev_cursor else None
+
+    @property
+    def next_url(self):
+        return self._url_for(self.next_cursor) if self.next_cursor else None
+
+
+def paginate(stmt, keys, per_page, error_out=True, cursor=False):
+    """Paginate ``stmt`` ordered by ``keys`` descending.
+
+    Views opt into keyset pagination with ``cursor``, it is used when ``MOMENTS_CURSOR_PAGINATION``
+    is enabled too. Otherwise falls back to the numbered pages (and totals) of ``db.paginate``.
+    """
+    if cursor and current_app.config['MOMENTS_CURSOR_PAGINATION']:
+        return CursorPagination(stmt, keys, per_page, cursor=request.args.get('cursor'))
+    page = request.args.get('page', 1, type=int)
+    stmt = stmt.order_by(None).order_by(*[key.desc() for key in keys])
+    return db.paginate(stmt, page=page, per_page=per_page, error_out=error_out)
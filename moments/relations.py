@@ -0,0 +1,73 @@
+from flask import g
+from flask_login import current_user
+from sqlalchemy import and_, or_, select
+
+from moments.core.extensions import db
+from moments.models import Collection, Follow
+
+
+class RelationResolver:
+    """Answer the viewer's follow/collect state for a whole page.
+
+    Views hand over the users and photos they are about to render, and the edges between
+    them and the viewer are fetched with one ``IN (...)`` query per kind. Anything asked
+    about that was not loaded up front is fetched on demand the same way.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.following = set()
+        self.followers = set()
+        self.collected = set()
+        self.loaded_user_ids = set()
+        self.loaded_photo_ids = set()
+
+    def load_users(self, users):
+        if not self.user.is_authenticated:
+            return
+        user_ids = {user.id for user in users if user.id is not None} - self.loaded_user_ids
+        if not user_ids:
+            return
+        stmt = select(Follow.follower_id, Follow.followed_id).filter(
+            or_(
+                and_(Follow.follower_id == self.user.id, Follow.followed_id.in_(user_ids)),
+                and_(Follow.followed_id == self.user.id, Follow.follower_id.in_(user_ids)),
+            )
+        )
+        for follower_id, followed_id in db.session.execute(stmt):
+            if follower_id == self.user.id:
+                self.following.add(followed_id)
+            if followed_id == self.user.id:
+                self.followers.add(follower_id)
+        self.loaded_user_ids |= user_ids
+
+    def load_photos(self, photos):
+        if not self.user.is_authenticated:
+            return
+        photo_ids = {photo.id for photo in photos} - self.loaded_photo_ids
+        if not photo_ids:
+            return
+        stmt = select(Collection.photo_id).filter(
+            Collection.user_id == self.user.id, Collection.photo_id.in_(photo_ids)
+        )
+        self.collected.update(db.session.scalars(stmt))
+        self.loaded_photo_ids |= photo_ids
+
+    def is_following(self, user):
+        self.load_users([user])
+        return user.id in self.following
+
+    def is_followed_by(self, user):
+        self.load_users([user])
+        return user.id in self.followers
+
+    def is_collecting(self, photo):
+        self.load_photos([photo])
+        return photo.id in self.collected
+
+
+def get_relations():
+    """Return the relation resolver of the current user for this request."""
+    if 'relations' not in g:
+        g.relations = RelationResolver(current_user._get_current_object())
+    return g.relations
@@ -25,9 +25,50 @@ class BaseConfig:
     MOMENTS_MANAGE_USER_PER_PAGE = 30
     MOMENTS_MANAGE_TAG_PER_PAGE = 50
     MOMENTS_MANAGE_COMMENT_PER_PAGE = 30
+    MOMENTS_MANAGE_JOB_PER_PAGE = 30
     MOMENTS_SEARCH_RESULT_PER_PAGE = 20
+    MOMENTS_HOT_TAG_NUMBER = 10
+    MOMENTS_EXPLORE_POOL_SIZE = 1000  # photo ids the explore page samples from
+    MOMENTS_EXPLORE_POOL_TIMEOUT = 60  # seconds before the pool is reshuffled
     MOMENTS_MAIL_SUBJECT_PREFIX = '[Moments]'
     MOMENTS_UPLOAD_PATH = os.getenv('MOMENTS_UPLOAD_PATH', BASE_DIR / 'uploads')
+    MOMENTS_CACHE_BACKEND = os.getenv('MOMENTS_CACHE_BACKEND', 'memory')  # 'memory' or 'redis' for multiple workers
+    MOMENTS_CACHE_REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost')
+    MOMENTS_CACHE_SIZE = 10000
+    MOMENTS_CACHE_DEFAULT_TIMEOUT = 300
+    MOMENTS_BROKER_BACKEND = os.getenv('MOMENTS_BROKER_BACKEND', 'memory')  # 'memory' or 'redis' for multiple workers
+    MOMENTS_BROKER_REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost')
+    # push the unread count over Server-Sent Events instead of polling. Each open tab holds a request for the
+    # stream timeout, so it needs threaded or async workers (e.g. gunicorn --threads or -k gevent), and the
+    # redis broker as soon as there is more than one worker process, so it defaults to polling otherwise
+    MOMENTS_NOTIFICATION_STREAM = MOMENTS_BROKER_BACKEND == 'redis'
+    MOMENTS_NOTIFICATION_STREAM_TIMEOUT = 300  # seconds before the browser is asked to reconnect
+    MOMENTS_NOTIFICATION_STREAM_KEEPALIVE = 15
+    MOMENTS_CURSOR_PAGINATION = True  # keyset pagination for the views that opt in, the feed and profiles
+    MOMENTS_TIMELINE_PULL_THRESHOLD = 1000  # authors with more followers are merged into feeds at read time
+    MOMENTS_JOB_MAX_ATTEMPTS = 3
+    MOMENTS_JOB_RETRY_DELAY = 30  # seconds, doubled after each failed attempt
+    MOMENTS_JOB_TIMEOUT = 600  # running jobs older than this are given to another worker
+    MOMENTS_WORKER_INTERVAL = 2  # seconds between polls of an empty queue
+    MOMENTS_ML_BATCH_SIZE = 8  # images per forward pass
+    MOMENTS_ML_BATCH_WAIT = 0.5  # seconds a worker waits for a batch to fill up
+    MOMENTS_ML_BACKEND = os.getenv('MOMENTS_ML_BACKEND', 'fp32')  # 'fp32', 'int8' or 'exported'
+    MOMENTS_ML_SERVER_URL = os.getenv('MOMENTS_ML_SERVER_URL')  # `flask ml-server`, e.g. http://127.0.0.1:5001
+    MOMENTS_ML_SERVER_BATCH_WAIT = 0.05  # seconds the inference server waits to merge concurrent requests
+    # 'fast', 'balanced', 'quality' or 'adaptive'
+    MOMENTS_ML_CAPTION_PROFILE = os.getenv('MOMENTS_ML_CAPTION_PROFILE', 'quality')
+    MOMENTS_ML_CAPTION_BUDGET = 2.0  # seconds per photo the adaptive profile may spend on a caption
+    MOMENTS_ML_BACKLOG_THRESHOLD = 50  # queued photos beyond which the adaptive profile switches to 'fast'
+    MOMENTS_ML_MODEL_DIR = os.getenv('MOMENTS_ML_MODEL_DIR')  # local copies of the models, e.g. /models/yolos-tiny
+    MOMENTS_ML_WARMUP = os.getenv('MOMENTS_ML_WARMUP', 'false').lower() in ('1', 'true')  # load models at boot
+    MOMENTS_ML_BACKFILL_PROCESSES = 2
+    MOMENTS_ML_BACKFILL_RATE = 0  # photos per second, 0 for no limit
+    MOMENTS_ML_BACKFILL_CHECKPOINT = BASE_DIR / 'ml-backfill.json'
+    # the thumbnail pool is per web server process, so both settings multiply with the server processes
+    MOMENTS_DERIVATIVE_WORKERS = 2  # processes creating thumbnails, 0 to create them in the request
+    MOMENTS_DERIVATIVE_MAX_PENDING = 60  # unfinished uploads per server process before falling back to the request
+    MOMENTS_PHOTO_FORMATS = ['avif', 'webp']  # alternative thumbnail formats, by preference, if Pillow supports them
+    MOMENTS_PHOTO_SRCSET_WIDTHS = [200, 600, 1200]  # thumbnails for srcset only, next to MOMENTS_PHOTO_SIZES
     MOMENTS_PHOTO_SIZES = {'small': 400, 'medium': 800}
     MOMENTS_PHOTO_SUFFIXES = {
         MOMENTS_PHOTO_SIZES['small']: '_s',  # thumbnail
@@ -64,12 +105,15 @@ class BaseConfig:
 class DevelopmentConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = SQLITE_PREFIX + str(BASE_DIR / 'data-dev.db')
     REDIS_URL = 'redis://localhost'
+    MOMENTS_NOTIFICATION_STREAM = True  # the threaded development server is a single process
 
 
 class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///'  # in-memory database
+    MOMENTS_DERIVATIVE_WORKERS = 0
+    MOMENTS_NOTIFICATION_STREAM = True
 
 
 class ProductionConfig(BaseConfig):
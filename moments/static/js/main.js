@@ -94,24 +94,45 @@ document.addEventListener('DOMContentLoaded', () => {
       .catch(handleFetchError);
   }
 
-  function updateNotificationsCount() {
+  function renderNotificationsCount(count) {
     const elem = document.getElementById('notification-badge');
-    if (!elem) {
-      return;
+    if (count === 0) {
+      elem.style.display = 'none';
+    } else {
+      elem.style.display = 'block';
+      elem.textContent = count;
     }
+  }
+
+  function updateNotificationsCount() {
+    const elem = document.getElementById('notification-badge');
     fetch(elem.dataset.href)
       .then(response => response.json())
-      .then(data => {
-        if (data.count === 0) {
-          elem.style.display = 'none';
-        } else {
-          elem.style.display = 'block';
-          elem.textContent = data.count;
-        }
-      })
+      .then(data => renderNotificationsCount(data.count))
       .catch(handleFetchError);
   }
 
+  function listenNotifications() {
+    const elem = document.getElementById('notification-badge');
+    if (!elem) {
+      return;
+    }
+    if (!window.EventSource || !elem.dataset.streamHref) {
+      setInterval(updateNotificationsCount, 30000);
+      return;
+    }
+    const source = new EventSource(elem.dataset.streamHref);
+    const handleEvent = event => renderNotificationsCount(JSON.parse(event.data).count);
+    source.addEventListener('count', handleEvent);
+    source.addEventListener('notification', handleEvent);
+    source.addEventListener('error', () => {
+      // the browser reconnects by itself unless the stream was refused, fall back to polling then
+      if (source.readyState === EventSource.CLOSED) {
+        setInterval(updateNotificationsCount, 30000);
+      }
+    });
+  }
+
   function follow(event) {
     const elem = event.target;
     const id = elem.dataset.id;
@@ -285,7 +306,7 @@ document.addEventListener('DOMContentLoaded', () => {
   }
 
   if (isAuthenticated) {
-    setInterval(updateNotificationsCount, 30000);
+    listenNotifications();
   }
 
   const tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'));
@@ -1,13 +1,16 @@
+import base64
+import io
 import uuid
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urljoin, urlparse
 from pathlib import Path
+from typing import NamedTuple, Optional
 
 import jwt
 import PIL
 from flask import current_app, flash, redirect, request, url_for
 from jwt.exceptions import InvalidTokenError
-from PIL import Image
+from PIL import Image, features
 
 
 def generate_token(user, operation, expiration=3600, **kwargs):
@@ -37,18 +40,104 @@ def rename_image(old_filename):
     return new_filename
 
 
-def resize_image(image, filename, base_width):
+# encoder settings of the alternative formats served to the browsers accepting them
+IMAGE_FORMAT_OPTIONS = {
+    'avif': {'quality': 60, 'speed': 8},
+    'webp': {'quality': 80, 'method': 4},
+}
+
+
+def supported_image_formats(formats):
+    """Keep the alternative formats this Pillow build can encode."""
+    modules = features.get_supported_modules()
+    return [fmt for fmt in formats if fmt in modules]
+
+
+def alternative_filename(filename, fmt):
+    return str(Path(filename).with_suffix(f'.{fmt}'))
+
+
+def is_thumbnail(filename, suffixes):
+    """Tell a thumbnail, named ``<original><suffix><ext>``, from an uploaded original."""
+    return Path(filename).stem.endswith(tuple(suffixes.values()))
+
+
+def save_alternatives(img, path, formats):
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+    for fmt in formats:
+        img.save(alternative_filename(path, fmt), **IMAGE_FORMAT_OPTIONS[fmt])
+
+
+class Thumbnail(NamedTuple):
+    filename: str
+    width: int
+    height: int
+
+
+class ThumbnailSet(NamedTuple):
+    original: Thumbnail
+    thumbnails: dict  # width -> Thumbnail, the original for the widths it does not exceed
+    formats: list  # alternative formats written next to every resized thumbnail
+    placeholder: Optional[str]  # data URI shown while the thumbnail loads
+
+
+PLACEHOLDER_WIDTH = 16
+
+
+def create_placeholder(img):
+    """Encode a tiny blurry JPEG of the image as a data URI, a few hundred bytes to inline in the page.
+
+    Return None for images with transparency, the placeholder would show through them.
+    """
+    if img.has_transparency_data:
+        return None
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    tiny = img.resize((PLACEHOLDER_WIDTH, max(round(img.height * PLACEHOLDER_WIDTH / img.width), 1)), Image.BOX)
+    buffer = io.BytesIO()
+    tiny.save(buffer, 'JPEG', quality=40, optimize=True)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def thumbnail_suffixes(config):
+    """Map the width of every thumbnail, ``MOMENTS_PHOTO_SIZES`` and the srcset widths, to its filename suffix."""
+    suffixes = {width: f'_w{width}' for width in config['MOMENTS_PHOTO_SRCSET_WIDTHS']}
+    suffixes.update(config['MOMENTS_PHOTO_SUFFIXES'])
+    return suffixes
+
+
+def create_thumbnails(path, filename, suffixes, formats=()):
+    """Create the thumbnails of an uploaded image next to it.
+
+    ``suffixes`` maps every thumbnail width to its filename suffix. The upload is decoded once,
+    JPEG files in draft mode so libjpeg already downscales by 1/2, 1/4 or 1/8 to the smallest
+    scale still covering the largest thumbnail, then every size is resized from the previous,
+    larger one. Images not wider than a size keep the original file for it.
+
+    Every resized thumbnail is also encoded in the supported ``formats``, e.g. ``abc.jpg_s.webp``
+    next to ``abc.jpg_s.jpg``, see ``alternative_filename``. The original is never re-encoded,
+    it is served as uploaded even where it stands in for a thumbnail.
+
+    The placeholder is made from the smallest thumbnail, already in memory.
+
+    Needs no app context, so it can run in the derivative process pool.
+    """
     ext = Path(filename).suffix
-    img = Image.open(image)
-    if img.size[0] <= base_width:
-        return filename
-    w_percent = base_width / float(img.size[0])
-    h_size = int(float(img.size[1]) * float(w_percent))
-    img = img.resize((base_width, h_size), PIL.Image.LANCZOS)
-
-    filename += current_app.config['MOMENTS_PHOTO_SUFFIXES'][base_width] + ext
-    img.save(current_app.config['MOMENTS_UPLOAD_PATH'] / filename, optimize=True, quality=85)
-    return filename
+    formats = supported_image_formats(formats)
+    with Image.open(path) as img:  # closes the upload, not the resized copies bound to img below
+        width, height = img.size
+        original = Thumbnail(filename, width, height)
+        widths = sorted((base_width for base_width in suffixes if base_width < width), reverse=True)
+        thumbnails = dict.fromkeys(suffixes, original)
+        if img.format == 'JPEG' and widths:
+            img.draft(img.mode, (widths[0], round(height * widths[0] / width)))
+        for base_width in widths:
+            img = img.resize((base_width, int(height * base_width / width)), PIL.Image.LANCZOS)
+            thumbnails[base_width] = Thumbnail(filename + suffixes[base_width] + ext, *img.size)
+            img.save(Path(path).parent / thumbnails[base_width].filename, optimize=True, quality=85)
+            save_alternatives(img, Path(path).parent / thumbnails[base_width].filename, formats)
+        return ThumbnailSet(original, thumbnails, formats, create_placeholder(img))
 
 
 def validate_image(filename):
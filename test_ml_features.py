@@ -12,7 +12,10 @@ sys.path.insert(0, str(Path(__file__).parent))
 def test_ml_services():
     """Test the ML services with a sample image."""
     try:
-        from moments.ml_services import ml_analyzer
+        from moments import create_app
+        from moments.ml_services import MLAnalyzer
+
+        ml_analyzer = MLAnalyzer.create(create_app('development').config)
         
         # Create a test image path (you would need an actual image file)
         test_image_path = "/workspace/test_image.jpg"
@@ -1,5 +1,5 @@
 from moments.core.extensions import db
-from moments.models import Role, Tag, User
+from moments.models import Job, Photo, Role, Tag, User
 from tests import BaseTestCase
 
 
@@ -145,11 +145,50 @@ class AdminTestCase(BaseTestCase):
         self.assertIn('Manage Photos', data)
         self.assertIn('Order by time', data)
 
+    def test_manage_photo_page_numbered_pagination(self):
+        self.app.config['MOMENTS_MANAGE_PHOTO_PER_PAGE'] = 1
+        response = self.client.get('/admin/manage/photo/by_time')
+        data = response.get_data(as_text=True)
+        self.assertIn('<small class="text-muted">2</small>', data)
+        self.assertIn('page=2', data)
+        self.assertNotIn('cursor=', data)
+
+        response = self.client.get('/admin/manage/photo/by_time?page=5')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('page=2', response.location)
+
     def test_manage_tag_page(self):
         response = self.client.get('/admin/manage/tag')
         data = response.get_data(as_text=True)
         self.assertIn('Manage Tags', data)
 
+    def test_manage_job_page(self):
+        photo = db.session.get(Photo, 1)
+        db.session.add(Job(kind='analyze_photo', photo=photo, status='failed', attempts=3, error='RuntimeError: boom'))
+        db.session.commit()
+        response = self.client.get('/admin/')
+        self.assertIn('Failed: 1', response.get_data(as_text=True))
+
+        response = self.client.get('/admin/manage/job?filter=failed')
+        data = response.get_data(as_text=True)
+        self.assertIn('Manage Jobs', data)
+        self.assertIn('RuntimeError: boom', data)
+
+        response = self.client.post('/admin/retry/job/1', follow_redirects=True)
+        self.assertIn('Job queued.', response.get_data(as_text=True))
+        job = db.session.get(Job, 1)
+        self.assertEqual((job.status, job.attempts, photo.ml_status), ('pending', 0, 'pending'))
+
+        job.status = 'running'
+        db.session.commit()
+        response = self.client.post('/admin/retry/job/1', follow_redirects=True)
+        self.assertIn('Job is running.', response.get_data(as_text=True))
+        self.assertEqual(db.session.get(Job, 1).status, 'running')
+
+        response = self.client.post('/admin/delete/job/1', follow_redirects=True)
+        self.assertIn('Job deleted.', response.get_data(as_text=True))
+        self.assertIsNone(db.session.get(Job, 1))
+
     def test_manage_comment_page(self):
         response = self.client.get('/admin/manage/comment')
         data = response.get_data(as_text=True)
@@ -1,5 +1,6 @@
 from moments.core.extensions import db
-from moments.models import Photo, User
+from moments.models import Notification, Photo, User
+from moments.notifications import push_follow_notification
 from tests import BaseTestCase
 
 
@@ -14,6 +15,65 @@ class AjaxTestCase(BaseTestCase):
         response = self.client.get('/ajax/notifications-count')
         self.assertEqual(response.status_code, 200)
 
+    def test_notifications_count_cache(self):
+        self.login()
+        response = self.client.get('/ajax/notifications-count')
+        self.assertEqual(response.get_json()['count'], 0)
+        etag = response.headers['ETag']
+
+        response = self.client.get('/ajax/notifications-count', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        user = db.session.get(User, 2)
+        with self.app.test_request_context():
+            push_follow_notification(follower=db.session.get(User, 1), receiver=user)
+        notification = Notification(message='test', receiver=user)
+        db.session.add(notification)
+        db.session.commit()
+        response = self.client.get('/ajax/notifications-count', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['count'], 2)
+
+        self.client.post(f'/notifications/read/{notification.id}')
+        response = self.client.get('/ajax/notifications-count')
+        self.assertEqual(response.get_json()['count'], 1)
+
+        self.client.post('/notifications/read/all')
+        response = self.client.get('/ajax/notifications-count')
+        self.assertEqual(response.get_json()['count'], 0)
+
+    def test_notifications_stream(self):
+        response = self.client.get('/ajax/notifications-stream')
+        self.assertEqual(response.status_code, 403)
+
+        self.login()
+        response = self.client.get('/ajax/notifications-stream', buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = response.iter_encoded()
+        self.assertEqual(next(events), b'event: count\ndata: {"count": 0}\n\n')
+
+        with self.app.test_request_context():
+            push_follow_notification(follower=db.session.get(User, 1), receiver=db.session.get(User, 2))
+        event = next(events).decode()
+        self.assertTrue(event.startswith('event: notification\n'))
+        self.assertIn('"count": 1', event)
+        self.assertIn('followed you.', event)
+
+        self.client.post('/notifications/read/all')
+        self.assertEqual(next(events), b'event: count\ndata: {"count": 0}\n\n')
+        response.close()
+
+    def test_notifications_stream_disabled(self):
+        self.app.config['MOMENTS_NOTIFICATION_STREAM'] = False
+        self.login()
+        response = self.client.get('/ajax/notifications-stream')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('data-href="/ajax/notifications-count"', data)
+        self.assertNotIn('data-stream-href', data)
+
     def test_get_profile(self):
         response = self.client.get('/ajax/profile/1')
         data = response.get_data(as_text=True)
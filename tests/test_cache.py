@@ -0,0 +1,62 @@
+from sqlalchemy import event, select
+
+from moments.core.cache import LRUCache
+from moments.core.extensions import cache, db
+from moments.models import Permission, Role, User, role_permission
+from tests import BaseTestCase
+
+
+class CacheTestCase(BaseTestCase):
+    def test_permission_cache(self):
+        user = db.session.get(User, 2)
+        admin = db.session.get(User, 1)
+        self.assertTrue(user.can('UPLOAD'))
+
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', record)
+        self.assertTrue(user.can('COMMENT'))
+        self.assertFalse(user.can('MODERATE'))
+        self.assertFalse(user.can('UNKNOWN'))
+        self.assertTrue(admin.can('ADMIN'))
+        self.assertEqual(statements, [])
+
+        table = Role.get_permission_table()
+        user.lock()  # dirties the roles through role.users only
+        db.session.add(User(email='new@helloflask.com', name='New', username='new', password='123'))
+        db.session.commit()
+        self.assertIs(Role.get_permission_table(), table)
+
+        role = db.session.scalar(select(Role).filter_by(name='User'))
+        role.permissions.append(db.session.scalar(select(Permission).filter_by(name='MODERATE')))
+        db.session.commit()
+        self.assertIsNot(Role.get_permission_table(), table)
+        self.assertTrue(admin.can('MODERATE'))
+
+    def test_permission_cache_other_process(self):
+        user = db.session.get(User, 2)
+        self.assertFalse(user.can('MODERATE'))
+        # another process grants the permission and moves the version stamp
+        moderate = db.session.scalar(select(Permission).filter_by(name='MODERATE'))
+        db.session.execute(role_permission.insert().values(role_id=user.role_id, permission_id=moderate.id))
+        db.session.commit()
+        self.assertFalse(user.can('MODERATE'))
+        cache.set(Role.PERMISSION_VERSION_KEY, 'other', timeout=0)
+        with self.app.app_context():  # the next request
+            self.assertTrue(db.session.get(User, 2).can('MODERATE'))
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)  # evicts b, the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.incr('a', 2), 3)
+        self.assertIsNone(cache.incr('b'))
+        cache.set('d', 4, timeout=-1)  # already expired
+        self.assertIsNone(cache.get('d'))
@@ -1,5 +1,15 @@
+import shutil
+import tempfile
+from pathlib import Path
+from unittest.mock import Mock, patch
+
+from PIL import Image
+from sqlalchemy import update
+
 from moments.core.extensions import db
-from moments.models import Comment, Photo, Role, Tag, User
+from moments.jobs import claim_job, enqueue_analysis, job_handlers, release_stale_jobs, run_jobs
+from moments.ml_services import ml_analyzer
+from moments.models import AnalysisResult, Comment, Job, Photo, Role, Tag, User
 from tests import BaseTestCase
 
 
@@ -23,6 +33,192 @@ class CLITestCase(BaseTestCase):
         self.assertIn('Initialized the roles and permissions.', result.output)
         self.assertEqual(Role.query.count(), 4)
 
+    def test_rebuild_timeline_command(self):
+        db.create_all()
+        result = self.cli_runner.invoke(args=['rebuild-timeline'])
+        self.assertIn('Rebuilt the timelines.', result.output)
+
+    def test_recount_command(self):
+        db.create_all()
+        user = User(email='test@helloflask.com', name='Test', username='test', password='123')
+        photo = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg', author=user)
+        db.session.add(photo)
+        db.session.commit()
+        db.session.execute(update(User).values(photos_count=5, followers_count=3))
+        db.session.commit()
+
+        result = self.cli_runner.invoke(args=['recount'])
+        self.assertIn('Recounted the counters.', result.output)
+        db.session.refresh(user)
+        self.assertEqual(user.photos_count, 1)
+        self.assertEqual(user.followers_count, 0)
+
+    def test_worker_command(self):
+        db.create_all()
+        user = User(email='test@helloflask.com', name='Test', username='test', password='123')
+        photo = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg', author=user)
+        enqueue_analysis(photo)
+        db.session.commit()
+        self.app.config['MOMENTS_JOB_MAX_ATTEMPTS'] = 2
+        self.app.config['MOMENTS_JOB_RETRY_DELAY'] = 0
+
+        def fail(photos):
+            raise RuntimeError('model unavailable')
+
+        with patch.dict(job_handlers, {'analyze_photo': fail}):
+            result = self.cli_runner.invoke(args=['worker', '--burst'])
+        self.assertIn('Processed 2 jobs.', result.output)  # the first attempt and one retry
+        job = db.session.scalar(db.select(Job))
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.error, 'RuntimeError: model unavailable')
+        self.assertEqual(photo.ml_status, 'failed')
+
+        job.status = 'pending'
+        db.session.commit()
+        photo2 = Photo(filename='test2.jpg', filename_s='test2_s.jpg', filename_m='test2_m.jpg', author=user)
+        enqueue_analysis(photo2)
+        db.session.commit()
+        batches = []
+
+        def analyze(photos):
+            batches.append([photo.id for photo in photos])
+            for photo in photos:
+                photo.ml_status = 'done'
+
+        self.app.config['MOMENTS_ML_BATCH_WAIT'] = 0
+        with patch.dict(job_handlers, {'analyze_photo': analyze}):
+            result = self.cli_runner.invoke(args=['worker', '--burst'])
+        self.assertIn('Processed 2 jobs.', result.output)
+        self.assertEqual(batches, [[photo.id, photo2.id]])  # both jobs share one batch
+        self.assertIsNone(db.session.scalar(db.select(Job)))
+        self.assertEqual((photo.ml_status, photo2.ml_status), ('done', 'done'))
+
+    def test_worker_model_failure(self):
+        db.create_all()
+        upload_path = self.app.config['MOMENTS_UPLOAD_PATH'] = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, upload_path)
+        Image.new('RGB', (100, 100), 'red').save(upload_path / 'test.jpg')
+        user = User(email='test@helloflask.com', name='Test', username='test', password='123')
+        photo = Photo(filename='test.jpg', filename_s='test.jpg', filename_m='test.jpg', author=user)
+        enqueue_analysis(photo)
+        db.session.commit()
+        self.app.config['MOMENTS_JOB_MAX_ATTEMPTS'] = 2
+        self.app.config['MOMENTS_JOB_RETRY_DELAY'] = 0
+
+        load = Mock(side_effect=OSError('no weights'))
+        with patch.multiple(ml_analyzer.analyzer, _load_caption_model=load, _load_detection_model=load):
+            result = self.cli_runner.invoke(args=['worker', '--burst'])
+        # retried like any failing job, nothing cached and the photo is not marked as analyzed
+        self.assertIn('Processed 2 jobs.', result.output)
+        job = db.session.scalar(db.select(Job))
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, f'AnalysisError: The models failed on photos [{photo.id}]')
+        self.assertEqual((photo.ml_status, photo.alt_text, photo.ml_version), ('failed', None, None))
+        self.assertIsNone(db.session.scalar(db.select(AnalysisResult)))
+
+    def test_worker_stale_job(self):
+        db.create_all()
+        user = User(email='test@helloflask.com', name='Test', username='test', password='123')
+        photo = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg', author=user)
+        enqueue_analysis(photo)
+        db.session.commit()
+        job = claim_job()
+        started_at = job.started_at
+        self.app.config['MOMENTS_JOB_TIMEOUT'] = -1
+
+        def slow(photos):
+            release_stale_jobs()  # another worker gives up on the job meanwhile
+            for photo in photos:
+                photo.ml_status = 'done'
+
+        with patch.dict(job_handlers, {'analyze_photo': slow}):
+            run_jobs([job])
+        job = db.session.scalar(db.select(Job))
+        self.assertEqual((job.status, job.started_at), ('pending', started_at))
+        self.assertEqual(photo.ml_status, 'pending')  # the results of the first run are discarded
+
+        self.app.config['MOMENTS_JOB_TIMEOUT'] = 600
+        with patch.dict(job_handlers, {'analyze_photo': slow}):
+            run_jobs([claim_job()])
+        self.assertIsNone(db.session.scalar(db.select(Job)))
+        self.assertEqual(photo.ml_status, 'done')
+
+    def test_ml_backfill_command(self):
+        db.create_all()
+        user = User(email='test@helloflask.com', name='Test', username='test', password='123')
+        for filename in ['a.jpg', 'bad.jpg', 'c.jpg', 'd.jpg']:
+            db.session.add(Photo(filename=filename, filename_s=filename, filename_m=filename, author=user))
+        queued = Photo(filename='e.jpg', filename_s='e.jpg', filename_m='e.jpg', author=user)
+        enqueue_analysis(queued)
+        db.session.commit()
+        version = ml_analyzer.model_version(self.app.config['MOMENTS_ML_CAPTION_PROFILE'])
+        batches = []
+
+        def analyze(photos):
+            batches.append([photo.filename for photo in photos])
+            for photo in photos:
+                if photo.filename == 'bad.jpg':
+                    raise OSError('cannot identify image file')
+                photo.ml_version = version
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.app.config['MOMENTS_ML_BACKFILL_CHECKPOINT'] = Path(directory.name) / 'backfill.json'
+        self.app.config['MOMENTS_ML_BATCH_SIZE'] = 2
+        with patch.dict(job_handlers, {'analyze_photo': analyze}):
+            result = self.cli_runner.invoke(args=['ml-backfill', '--processes', '1'])
+            self.assertIn('Done, 3 photos analyzed, 1 failed.', result.output)
+            # the failed batch is retried one by one, the queued photo is left to the workers
+            self.assertEqual(batches, [['a.jpg', 'bad.jpg'], ['a.jpg'], ['bad.jpg'], ['c.jpg', 'd.jpg']])
+            self.assertEqual(db.session.scalar(db.select(Photo).filter_by(filename='bad.jpg')).ml_status, 'failed')
+
+            # resumes after the checkpoint
+            result = self.cli_runner.invoke(args=['ml-backfill', '--processes', '1'])
+            self.assertIn('Done, 0 photos analyzed, 0 failed.', result.output)
+            result = self.cli_runner.invoke(args=['ml-backfill', '--processes', '1', '--restart'])
+            self.assertIn('Done, 0 photos analyzed, 1 failed.', result.output)
+            self.assertEqual(batches[-1], ['bad.jpg'])
+
+    def test_backfill_placeholders_command(self):
+        db.create_all()
+        upload_path = self.app.config['MOMENTS_UPLOAD_PATH'] = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, upload_path)
+        Image.new('RGB', (800, 600), 'red').save(upload_path / 'test.jpg')
+        Image.new('RGB', (400, 300), 'red').save(upload_path / 'test_s.jpg')
+        user = User(email='test@helloflask.com', name='Test', username='test', password='123')
+        photo = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test.jpg', author=user)
+        missing = Photo(filename='missing.jpg', filename_s='missing.jpg', filename_m='missing.jpg', author=user)
+        db.session.add_all([photo, missing])
+        db.session.commit()
+
+        result = self.cli_runner.invoke(args=['backfill-placeholders'])
+        self.assertIn(f'Skipped photo {missing.id}', result.output)
+        self.assertIn('Created 1 placeholders.', result.output)
+        self.assertEqual((photo.width, photo.height), (800, 600))
+        self.assertTrue(photo.placeholder.startswith('data:image/jpeg;base64,'))
+        self.assertIsNone(missing.placeholder)
+
+    def test_regenerate_thumbnails_command(self):
+        db.create_all()
+        upload_path = self.app.config['MOMENTS_UPLOAD_PATH'] = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, upload_path)
+        Image.new('RGB', (1000, 600), 'red').save(upload_path / 'test.jpg')
+        user = User(email='test@helloflask.com', name='Test', username='test', password='123')
+        # uploads whose thumbnails were lost with the server process
+        photo = Photo(filename='test.jpg', filename_s='test.jpg', filename_m='test.jpg', author=user)
+        missing = Photo(filename='missing.jpg', filename_s='missing.jpg', filename_m='missing.jpg', author=user)
+        db.session.add_all([photo, missing])
+        db.session.commit()
+
+        result = self.cli_runner.invoke(args=['regenerate-thumbnails'])
+        self.assertIn(f'Skipped photo {missing.id}', result.output)
+        self.assertIn('Created the thumbnails of 1 photos.', result.output)
+        self.assertEqual((photo.width, photo.height), (1000, 600))
+        self.assertEqual(Image.open(upload_path / photo.filename_s).size, (400, 240))
+        self.assertEqual(Image.open(upload_path / photo.filename_m).size, (800, 480))
+        self.assertIsNone(missing.width)
+
     def test_lorem_command(self):
         pass  # it will take too long time
 
@@ -1,8 +1,19 @@
 import io
+import re
+import shutil
+import tempfile
+import time
 from datetime import datetime, timedelta
+from pathlib import Path
 
-from moments.core.extensions import db
-from moments.models import Comment, Notification, Photo, Tag, User
+from PIL import Image
+from sqlalchemy import select
+
+from moments.core.derivatives import DerivativePool
+from moments.core.extensions import cache, db
+from moments.explore import ExploreSampler
+from moments.models import Comment, Job, Notification, Photo, Tag, Timeline, User
+from moments.utils import alternative_filename
 from tests import BaseTestCase
 
 
@@ -18,11 +29,115 @@ class MainTestCase(BaseTestCase):
         self.assertNotIn('Join Now', data)
         self.assertIn('My Home', data)
 
+    def test_index_timeline(self):
+        self.login()
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('test_m2.jpg', data)
+        self.assertNotIn('test_m.jpg', data)
+
+        user = db.session.get(User, 2)
+        user.follow(db.session.get(User, 1))
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('test_m.jpg', data)
+
+        user.unfollow(db.session.get(User, 1))
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertNotIn('test_m.jpg', data)
+
+    def test_hot_tags(self):
+        self.login()
+        response = self.client.get('/')
+        self.assertIn('test tag', response.get_data(as_text=True))
+
+        self.app.config['MOMENTS_HOT_TAG_NUMBER'] = 1
+        cache.delete(Tag.HOT_TAGS_KEY)
+        self.assertEqual(Tag.get_hot_tags(), [(1, 'test tag', 1)])
+
+        photo1, photo2 = db.session.get(Photo, 1), db.session.get(Photo, 2)
+        tag = Tag(name='hot')
+        photo1.tags.append(tag)
+        photo2.tags.append(tag)
+        db.session.commit()
+        self.assertIsNotNone(cache.get(Tag.HOT_TAGS_KEY))  # updated in place, not reloaded
+        self.assertEqual(Tag.get_hot_tags(), [(tag.id, 'hot', 2)])
+
+        photo1.tags.remove(tag)
+        photo2.tags.remove(tag)
+        db.session.commit()
+        self.assertEqual(Tag.get_hot_tags(), [(1, 'test tag', 1)])
+
+        db.session.delete(photo1)
+        db.session.commit()
+        self.assertEqual(Tag.get_hot_tags(), [])
+
+    def test_index_timeline_pull(self):
+        self.app.config['MOMENTS_TIMELINE_PULL_THRESHOLD'] = 0
+        admin = db.session.get(User, 1)
+        user = db.session.get(User, 2)
+        user.follow(admin)
+        photo = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='pulled_m.jpg', author=admin)
+        db.session.add(photo)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(select(Timeline).filter_by(photo_id=photo.id)).all(), [])
+
+        self.login()
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('pulled_m.jpg', data)
+
+    def test_index_timeline_pull_below_threshold(self):
+        self.app.config['MOMENTS_TIMELINE_PULL_THRESHOLD'] = 1
+        admin = db.session.get(User, 1)
+        locked = db.session.get(User, 4)
+        db.session.get(User, 2).follow(admin)
+        locked.follow(admin)
+        photo = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='pulled_m.jpg', author=admin)
+        db.session.add(photo)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(select(Timeline).filter_by(photo_id=photo.id)).all(), [])
+
+        locked.unfollow(admin)  # back to the threshold
+        self.app.config['MOMENTS_TIMELINE_PULL_THRESHOLD'] = 10
+        self.assertTrue(admin.timeline_pulled)
+        self.login()
+        response = self.client.get('/')
+        self.assertIn('pulled_m.jpg', response.get_data(as_text=True))
+
+        Timeline.rebuild()
+        self.assertFalse(db.session.get(User, 1).timeline_pulled)
+        self.assertIsNotNone(db.session.scalar(select(Timeline).filter_by(user_id=2, photo_id=photo.id)))
+        response = self.client.get('/')
+        self.assertIn('pulled_m.jpg', response.get_data(as_text=True))
+
     def test_explore_page(self):
         response = self.client.get('/explore')
         data = response.get_data(as_text=True)
         self.assertIn('Change', data)
 
+    def test_explore_sampler(self):
+        admin = db.session.get(User, 1)
+        for i in range(10):
+            db.session.add(Photo(filename=f'{i}.jpg', filename_s=f'{i}_s.jpg', filename_m=f'{i}_m.jpg', author=admin))
+        db.session.get(Photo, 2).flag = 1
+        db.session.commit()
+
+        sampler = ExploreSampler(pool_size=100, timeout=60)
+        photos = sampler.sample(12)
+        self.assertEqual(len(photos), 11)
+        self.assertNotIn(2, [photo.id for photo in photos])
+
+        sampler = ExploreSampler(pool_size=4, timeout=60)
+        sampler.RUN_LENGTH = 2
+        self.assertTrue(1 <= len(sampler.get_pool()) <= 4)
+        self.assertNotIn(2, sampler.get_pool())
+        self.assertTrue(1 <= len(sampler.sample(3)) <= 3)
+
+        response = self.client.get('/explore')
+        self.assertNotIn('test_s2.jpg', response.get_data(as_text=True))
+
     def test_search(self):
         response = self.client.get('/search?q=', follow_redirects=True)
         data = response.get_data(as_text=True)
@@ -208,6 +323,39 @@ class MainTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('Not collect yet.', data)
 
+    def test_counters(self):
+        admin = db.session.get(User, 1)
+        user = db.session.get(User, 2)
+        photo = db.session.get(Photo, 1)
+        tag = db.session.get(Tag, 1)
+        self.assertEqual((photo.comments_count, photo.collectors_count, tag.photos_count), (1, 0, 1))
+        self.assertEqual((admin.photos_count, admin.followers_count, user.following_count), (1, 0, 0))
+
+        user.collect(photo)
+        user.follow(admin)
+        reply = Comment(body='reply', photo=photo, author=admin, replied=db.session.get(Comment, 1))
+        db.session.add(reply)
+        db.session.commit()
+        self.assertEqual((photo.comments_count, photo.collectors_count), (2, 1))
+        self.assertEqual((admin.followers_count, user.following_count, user.collections_count), (1, 1, 1))
+
+        db.session.delete(db.session.get(Comment, 1))  # the reply goes with it
+        photo.tags.remove(tag)
+        db.session.commit()
+        self.assertEqual((photo.comments_count, tag.photos_count), (0, 0))
+
+        photo.tags.append(tag)
+        db.session.commit()
+        self.assertEqual(tag.photos_count, 1)
+
+        db.session.delete(photo)
+        db.session.commit()
+        self.assertEqual((admin.photos_count, tag.photos_count, user.collections_count), (0, 0, 0))
+
+        db.session.delete(user)
+        db.session.commit()
+        self.assertEqual(admin.followers_count, 0)
+
     def test_report_comment(self):
         self.assertEqual(db.session.get(Comment, 1).flag, 0)
 
@@ -315,6 +463,29 @@ class MainTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('Order by collections', data)
 
+    def test_show_tag_order_by_collections(self):
+        self.app.config['MOMENTS_PHOTO_PER_PAGE'] = 1
+        photo1, photo2 = db.session.get(Photo, 1), db.session.get(Photo, 2)
+        photo2.tags.append(db.session.get(Tag, 1))
+        db.session.get(User, 1).collect(photo2)
+
+        response = self.client.get('/tag/1')
+        data = response.get_data(as_text=True)
+        self.assertIn('test_s2.jpg', data)  # the newest photo comes first by time
+
+        photo1.created_at = datetime.now() + timedelta(days=1)
+        db.session.commit()
+        response = self.client.get('/tag/1?order_rule=collections')
+        data = response.get_data(as_text=True)
+        self.assertIn('test_s2.jpg', data)
+        self.assertNotIn('test_s.jpg', data)
+        # keyset pages, the order is kept across them
+        next_url = re.search(r'href="(/tag/1\?[^"]*cursor=[^"]+)">Next', data).group(1)
+        self.assertIn('order_rule=collections', next_url)
+        data = self.client.get(next_url.replace('&amp;', '&')).get_data(as_text=True)
+        self.assertIn('test_s.jpg', data)
+        self.assertNotIn('test_s2.jpg', data)
+
     def test_delete_tag(self):
         photo = db.session.get(Photo, 2)
         tag = Tag(name='test')
@@ -342,3 +513,122 @@ class MainTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertEqual(response.status_code, 400)
         self.assertIn('Invalid image.', data)
+
+    def test_upload_image_queues_analysis(self):
+        self.app.config['MOMENTS_UPLOAD_PATH'] = Path(tempfile.mkdtemp())
+        image = io.BytesIO()
+        Image.new('RGB', (1000, 600), 'white').save(image, 'PNG')
+        image.seek(0)
+
+        self.login()
+        response = self.client.post('/upload', data=dict(file=(image, 'test.png')))
+        self.assertEqual(response.status_code, 200)
+        photo = db.session.scalar(select(Photo).order_by(Photo.id.desc()))
+        self.assertEqual(photo.ml_status, 'pending')
+        self.assertIsNone(photo.alt_text)
+        job = db.session.scalar(select(Job))
+        self.assertEqual((job.kind, job.photo_id, job.status), ('analyze_photo', photo.id, 'pending'))
+        shutil.rmtree(self.app.config['MOMENTS_UPLOAD_PATH'])
+
+    def test_upload_image_thumbnails(self):
+        upload_path = self.app.config['MOMENTS_UPLOAD_PATH'] = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, upload_path)
+        self.login()
+        for size, name in [((2000, 1000), 'big.jpg'), ((300, 200), 'small.jpg')]:
+            image = io.BytesIO()
+            Image.new('RGB', size, 'white').save(image, 'JPEG')
+            image.seek(0)
+            self.client.post('/upload', data=dict(file=(image, name)))
+
+        big, small = db.session.scalars(select(Photo).order_by(Photo.id.desc()).limit(2)).all()[::-1]
+        self.assertTrue(big.filename_s.endswith('_s.jpg'))
+        self.assertEqual(Image.open(upload_path / big.filename_s).size, (400, 200))
+        self.assertEqual(Image.open(upload_path / big.filename_m).size, (800, 400))
+        # not wider than the thumbnails, the original is used
+        self.assertEqual((small.filename_s, small.filename_m), (small.filename, small.filename))
+        self.assertEqual([thumbnail.width for thumbnail in small.get_thumbnails()], [200, 300])
+
+        self.assertEqual((big.width, big.height), (2000, 1000))
+        thumbnails = big.get_thumbnails()
+        self.assertEqual([thumbnail[1:] for thumbnail in thumbnails], [(w, w // 2) for w in [200, 400, 600, 800, 1200]])
+        for thumbnail in thumbnails:
+            self.assertEqual(Image.open(upload_path / thumbnail.filename).width, thumbnail.width)
+        data = self.client.get(f'/photo/{big.id}').get_data(as_text=True)
+        self.assertIn(f'/images/{thumbnails[0].filename} 200w, ', data)
+        self.assertIn('width="2000" height="1000"', data)
+        self.assertTrue(big.placeholder.startswith('data:image/jpeg;base64,'))
+        self.assertLess(len(big.placeholder), 1000)
+        data = self.client.get(f'/user/{big.author.username}').get_data(as_text=True)
+        self.assertIn(f'url({big.placeholder})', data)
+
+    def test_get_image_negotiates_format(self):
+        upload_path = self.app.config['MOMENTS_UPLOAD_PATH'] = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, upload_path)
+        self.app.config['MOMENTS_PHOTO_FORMATS'] = ['webp']
+        image = io.BytesIO()
+        Image.new('RGB', (1000, 600), 'white').save(image, 'JPEG')
+        image.seek(0)
+        self.login()
+        self.client.post('/upload', data=dict(file=(image, 'test.jpg')))
+        photo = db.session.scalar(select(Photo).order_by(Photo.id.desc()))
+        self.assertEqual(photo.image_formats, 'webp')
+
+        url = f'/images/{photo.filename_s}'
+        response = self.client.get(url, headers={'Accept': 'image/webp,*/*'})
+        self.assertEqual(response.mimetype, 'image/webp')
+        self.assertIn('Accept', response.vary)
+        self.assertEqual(Image.open(io.BytesIO(response.data)).size, (400, 240))
+        response = self.client.get(url, headers={'Accept': '*/*'})
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        response = self.client.get(url, headers={'Accept': 'image/avif'})
+        self.assertEqual(response.mimetype, 'image/jpeg')  # not created
+
+        # the original is never negotiated, even where it stands in for the small thumbnail
+        response = self.client.get(f'/images/{photo.filename}', headers={'Accept': 'image/avif,image/webp'})
+        self.assertEqual(response.data, (upload_path / photo.filename).read_bytes())
+        self.client.post(f'/delete/photo/{photo.id}', follow_redirects=True)
+        self.assertEqual(list(upload_path.iterdir()), [])
+
+        image = io.BytesIO()
+        Image.new('RGB', (300, 200), 'white').save(image, 'JPEG')
+        uploaded = image.getvalue()
+        image.seek(0)
+        self.client.post('/upload', data=dict(file=(image, 'small.jpg')))
+        photo = db.session.scalar(select(Photo).order_by(Photo.id.desc()))
+        self.assertEqual(photo.filename_s, photo.filename)
+        response = self.client.get(f'/images/{photo.filename_s}', headers={'Accept': 'image/avif,image/webp'})
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertEqual(response.data, uploaded)
+        self.assertFalse((upload_path / alternative_filename(photo.filename, 'webp')).exists())
+
+    def test_upload_image_derivative_pool(self):
+        upload_path = self.app.config['MOMENTS_UPLOAD_PATH'] = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, upload_path)
+        pool = self.app.extensions['moments_derivatives'] = DerivativePool(self.app, 1, 10)
+        self.addCleanup(pool.shutdown)
+        image = io.BytesIO()
+        Image.new('RGB', (1000, 600), 'white').save(image, 'JPEG')
+        image.seek(0)
+
+        self.login()
+        self.client.post('/upload', data=dict(file=(image, 'test.jpg')))
+        photo = db.session.scalar(select(Photo).order_by(Photo.id.desc()))
+        # served from the original until the pool is done
+        self.assertEqual((photo.filename_s, photo.filename_m), (photo.filename, photo.filename))
+        for _ in range(300):
+            if not pool.pending:
+                break
+            time.sleep(0.1)
+        db.session.refresh(photo)
+        self.assertEqual(Image.open(upload_path / photo.filename_s).size, (400, 240))
+        self.assertEqual(Image.open(upload_path / photo.filename_m).size, (800, 480))
+
+        # a pool that cannot take work anymore falls back to the request
+        pool.executor.shutdown()
+        image = io.BytesIO()
+        Image.new('RGB', (1000, 600), 'white').save(image, 'JPEG')
+        image.seek(0)
+        self.client.post('/upload', data=dict(file=(image, 'test.jpg')))
+        photo = db.session.scalar(select(Photo).order_by(Photo.id.desc()))
+        self.assertEqual(Image.open(upload_path / photo.filename_s).size, (400, 240))
+        self.assertEqual(pool.pending, 0)
@@ -0,0 +1,327 @@
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from flask import current_app
+from PIL import Image
+from sqlalchemy import insert, select
+
+from moments import create_app
+from moments.core.extensions import db
+from moments.jobs import analyze_uncached, file_sha256
+from moments.ml_services import DecodedImage, MLImageAnalyzer, ml_analyzer
+from moments.models import AnalysisResult
+from tests import BaseTestCase
+
+
+class MLTestCase(BaseTestCase):
+    def test_ml_batches(self):
+        analyzer = MLImageAnalyzer(batch_size=2)
+        sizes = {'a': (30, 10), 'b': (10, 30), 'c': (20, 20), 'd': (31, 10)}
+        decoded = [DecodedImage(Image.new('RGB', size), size, name) for name, size in sizes.items()]
+        decoded.insert(2, None)  # could not be decoded
+        batches = []
+
+        def run_batch(batch):
+            batches.append([image.name for image in batch])
+            if 'c' in batches[-1]:
+                raise RuntimeError('bad image')
+            return [[image.name] for image in batch]
+
+        results = analyzer._map_decoded(decoded, None, run_batch)
+        # batched by aspect ratio, the failed batch is retried one by one
+        self.assertEqual(batches, [['b', 'c'], ['b'], ['c'], ['a', 'd']])
+        self.assertEqual([results[i] for i in (0, 1, 4)], [['a'], ['b'], ['d']])
+        self.assertEqual(str(results[2]), 'The image could not be decoded')
+        self.assertEqual(str(results[3]), 'RuntimeError: bad image')
+
+    def test_caption_batch(self):
+        import torch
+
+        class Inputs(dict):
+            def to(self, device):
+                return self
+
+        class Processor:
+            def __call__(self, images, return_tensors):
+                self.sizes = [image.size for image in images]
+                return Inputs(pixel_values=torch.zeros(len(images), 3, 4, 4))
+
+            def batch_decode(self, out, skip_special_tokens):
+                return [f'caption {row[0]}' for row in out.tolist()]
+
+        class Model:
+            def generate(self, pixel_values, **kwargs):
+                self.kwargs = kwargs
+                return torch.arange(len(pixel_values)).unsqueeze(1)
+
+        analyzer = MLImageAnalyzer()
+        analyzer._device = 'cpu'
+        analyzer.caption_processor, analyzer.caption_model = Processor(), Model()
+        images = [DecodedImage(Image.new('RGB', (width, 10)), (width, 10), f'{width}.jpg') for width in (10, 20)]
+        self.assertEqual(analyzer._caption_batch(images, 'fast'), ['caption 0', 'caption 1'])
+        self.assertEqual(analyzer.caption_processor.sizes, [(10, 10), (20, 10)])
+        self.assertEqual(analyzer.caption_model.kwargs, MLImageAnalyzer.CAPTION_PROFILES['fast'])
+        self.assertIn('fast', analyzer.caption_latency)
+
+    def test_detect_batch(self):
+        import torch
+
+        class Processor:
+            def __call__(self, images, return_tensors):
+                # resized to half the size, ones tell the image from the padding
+                return {'pixel_values': torch.ones(1, 3, images.height // 2, images.width // 2)}
+
+            def post_process_object_detection(self, outputs, target_sizes, threshold):
+                self.target_sizes = target_sizes.tolist()
+                return [
+                    {'scores': torch.tensor([0.5 + i]), 'labels': torch.tensor([i]), 'boxes': torch.ones(1, 4)}
+                    for i in range(len(target_sizes))
+                ]
+
+        class Model:
+            config = SimpleNamespace(id2label={0: 'cat', 1: 'dog'})
+
+            def __call__(self, pixel_values):
+                self.pixel_values = pixel_values
+                return 'outputs'
+
+        analyzer = MLImageAnalyzer()
+        analyzer._device = 'cpu'
+        analyzer.detection_processor, analyzer.detection_model = Processor(), Model()
+        images = [
+            DecodedImage(Image.new('RGB', (40, 20)), (400, 200), 'wide.jpg'),
+            DecodedImage(Image.new('RGB', (20, 40)), (100, 200), 'tall.jpg'),
+        ]
+        detections = analyzer._detect_batch(images)
+        pixel_values = analyzer.detection_model.pixel_values
+        self.assertEqual(tuple(pixel_values.shape), (2, 3, 20, 20))  # padded to the largest input
+        self.assertEqual(pixel_values[0, :, :10, :].min().item(), 1)
+        self.assertEqual(pixel_values[0, :, 10:, :].max().item(), 0)
+        self.assertEqual(pixel_values[1, :, :, 10:].max().item(), 0)
+        # the boxes are scaled from the padded input back to each original
+        self.assertEqual(analyzer.detection_processor.target_sizes, [[400, 400], [200, 200]])
+        self.assertEqual(
+            detections,
+            [
+                [{'label': 'cat', 'confidence': 0.5, 'box': [1, 1, 1, 1]}],
+                [{'label': 'dog', 'confidence': 1.5, 'box': [1, 1, 1, 1]}],
+            ],
+        )
+
+    def test_decode_once(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        paths = [str(Path(directory.name) / name) for name in ('photo.jpg', 'bad.jpg', 'photo.png')]
+        Image.new('RGB', (2048, 1536), 'red').save(paths[0])
+        Path(paths[1]).write_bytes(b'not an image')
+        Image.new('RGB', (1000, 800), 'blue').save(paths[2])
+
+        analyzer = MLImageAnalyzer()
+        decoded = analyzer.decode_image(paths[0])
+        # drafted to the smallest JPEG scale that keeps both sides at least DECODE_SIZE
+        self.assertEqual((decoded.image.size, decoded.size), ((1024, 768), (2048, 1536)))
+        self.assertEqual(decoded.image.mode, 'RGB')
+        self.assertEqual(analyzer.decode_image(paths[2]).image.size, (1000, 800))  # no draft mode
+
+        analyzer.caption_model = analyzer.detection_model = object()  # loaded
+        analyzer._caption_batch = lambda images, profile: [f'{image.image.width} wide' for image in images]
+        analyzer._detect_batch = lambda images: [[{'label': image.name, 'confidence': 1.0}] for image in images]
+        with patch.object(analyzer, 'decode_image', wraps=analyzer.decode_image) as decode_image:
+            results = analyzer.analyze_batch(paths)
+        self.assertEqual(decode_image.call_count, 3)  # once for both models
+        # the undecodable file only falls back itself
+        captions = [result['alt_text'] for result in results]
+        self.assertEqual(captions, ['1024 wide', analyzer.FALLBACK_CAPTION, '1000 wide'])
+        self.assertEqual([result['error'] for result in results], [None, 'The image could not be decoded', None])
+
+        # the batch path reports models failing to load, the single image helpers fall back silently
+        analyzer = MLImageAnalyzer()
+        analyzer._load_caption_model = analyzer._load_detection_model = Mock(side_effect=OSError('no weights'))
+        result = analyzer.analyze_batch(paths[:1])[0]
+        self.assertEqual(
+            result['error'], 'Caption model unavailable: no weights; Detection model unavailable: no weights'
+        )
+        self.assertEqual((result['alt_text'], result['objects']), (analyzer.FALLBACK_CAPTION, []))
+        self.assertEqual(analyzer.generate_alt_text(paths[0]), analyzer.FALLBACK_CAPTION)
+        self.assertEqual(analyzer.detect_objects(paths[0]), [])
+        labels = [[obj['label'] for obj in result['objects']] for result in results]
+        self.assertEqual(labels, [[paths[0]], [], [paths[2]]])
+
+    def test_ml_backend(self):
+        self.assertEqual(MLImageAnalyzer(backend='int8').backend, 'int8')
+        with self.assertRaises(ValueError):
+            MLImageAnalyzer(backend='fp16')
+
+    def test_ml_backend_loading(self):
+        import torch
+        from torch.ao.nn.quantized.dynamic import Linear as QuantizedLinear
+
+        from moments.ml_graphs import TracedDetectionModel, TracedVisionModel
+
+        paths = []
+
+        class Pretrained:
+            @classmethod
+            def from_pretrained(cls, path):
+                paths.append(path)
+                return cls()
+
+        class CaptionProcessor(Pretrained):
+            image_processor = SimpleNamespace(size={'height': 8})
+
+        class VisionModel(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.linear = torch.nn.Linear(8, 4)
+
+            def forward(self, pixel_values):
+                return (self.linear(pixel_values),)
+
+        class CaptionModel(Pretrained, torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.vision_model = VisionModel()
+                self.text_decoder = torch.nn.Linear(4, 4)
+
+        class DetectionModel(Pretrained, torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.linear = torch.nn.Linear(8, 4)
+
+            def forward(self, pixel_values):
+                logits = self.linear(pixel_values)
+                return SimpleNamespace(logits=logits, pred_boxes=logits.sigmoid())
+
+        stubs = {
+            'BlipProcessor': CaptionProcessor,
+            'BlipForConditionalGeneration': CaptionModel,
+            'YolosImageProcessor': Pretrained,
+            'YolosForObjectDetection': DetectionModel,
+        }
+        for backend in MLImageAnalyzer.BACKENDS:
+            with self.subTest(backend=backend), patch.multiple('transformers', **stubs):
+                paths.clear()
+                analyzer = MLImageAnalyzer(backend=backend, model_dir='/models')
+                analyzer._device = 'cpu'
+                analyzer._load_caption_model()
+                analyzer._load_detection_model()
+                self.assertEqual(paths, ['/models/blip-image-captioning-base'] * 2 + ['/models/yolos-tiny'] * 2)
+                linear_types = {type(analyzer.caption_model.text_decoder), type(analyzer.detection_model.linear)}
+                if backend == 'int8':
+                    self.assertEqual(linear_types, {QuantizedLinear})
+                else:
+                    self.assertEqual(linear_types, {torch.nn.Linear})
+                if backend == 'exported':
+                    self.assertIsInstance(analyzer.caption_model.vision_model, TracedVisionModel)
+                    self.assertIsInstance(analyzer.traced_detection, TracedDetectionModel)
+                    outputs = analyzer.traced_detection(torch.ones(2, 3, 8, 8))
+                    self.assertEqual(tuple(outputs.logits.shape), (2, 3, 8, 4))
+                else:
+                    self.assertIsInstance(analyzer.caption_model.vision_model, VisionModel)
+                    self.assertIsNone(analyzer.traced_detection)
+
+    def test_ml_analyzer_config(self):
+        analyzer = ml_analyzer.analyzer
+        self.assertEqual(analyzer.backend, current_app.config['MOMENTS_ML_BACKEND'])
+        self.assertIsNone(analyzer.server_url)
+
+        app = create_app('testing')
+        app.config.update(
+            MOMENTS_ML_BACKEND='int8',
+            MOMENTS_ML_CAPTION_PROFILE='fast',
+            MOMENTS_ML_SERVER_URL='http://127.0.0.1:5001/',
+        )
+        ml_analyzer.init_app(app)
+        with app.app_context():
+            self.assertEqual(ml_analyzer.backend, 'int8')
+            self.assertEqual(ml_analyzer.caption_profile, 'fast')
+            self.assertEqual(ml_analyzer.server_url, 'http://127.0.0.1:5001')
+        self.assertIsNot(ml_analyzer.analyzer, app.extensions['moments_ml_analyzer'])
+
+    def test_caption_profile(self):
+        analyzer = MLImageAnalyzer(caption_profile='adaptive', caption_budget=1.0, backlog_threshold=10)
+        self.assertEqual(analyzer.resolve_caption_profile('balanced'), 'balanced')
+        self.assertEqual(analyzer.resolve_caption_profile(), 'quality')
+        self.assertEqual(analyzer.resolve_caption_profile(backlog=11), 'fast')
+        analyzer._record_caption_latency('quality', 3.0)
+        self.assertEqual(analyzer.resolve_caption_profile(), 'balanced')
+        analyzer._record_caption_latency('balanced', 1.5)
+        self.assertEqual(analyzer.resolve_caption_profile(), 'fast')
+        with self.assertRaises(ValueError):
+            analyzer.resolve_caption_profile('best')
+        with self.assertRaises(ValueError):
+            MLImageAnalyzer(caption_profile='best')
+
+    def test_analysis_cache(self):
+        class Analyzer:
+            analyzed = []
+
+            def analyze_batch(self, images, batch_size=None, profile=None, backlog=0):
+                self.analyzed.extend(images)
+                return [{'alt_text': 'a cat', 'objects': [{'label': 'cat'}], 'keywords': []} for _ in images]
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for name, color in [('a.png', 'red'), ('b.png', 'red'), ('c.png', 'blue')]:
+                paths.append(str(Path(directory) / name))
+                Image.new('RGB', (10, 10), color).save(paths[-1])
+            digests = [file_sha256(path) for path in paths]
+            self.assertEqual(digests[0], digests[1])
+
+            results = analyze_uncached(Analyzer(), paths, digests, 'v1')
+            self.assertEqual(Analyzer.analyzed, [paths[0], paths[2]])  # identical files analyzed once
+            self.assertEqual([result.alt_text for result in results], ['a cat'] * 3)
+            db.session.commit()
+
+            analyze_uncached(Analyzer(), paths[:1], digests[:1], 'v1')
+            self.assertEqual(len(Analyzer.analyzed), 2)
+            analyze_uncached(Analyzer(), paths[:1], digests[:1], 'v2')  # other models are not reused
+            self.assertEqual(len(Analyzer.analyzed), 3)
+            db.session.commit()
+        result = db.session.scalar(select(AnalysisResult).filter_by(sha256=digests[0], model_version='v1'))
+        self.assertEqual(result.hits, 1)
+        self.assertEqual(db.session.scalar(select(db.func.count(AnalysisResult.id))), 3)
+
+        class RacingAnalyzer(Analyzer):
+            def analyze_batch(self, images, batch_size=None, profile=None, backlog=0):
+                # another worker stores the same content while this one runs the models
+                db.session.execute(
+                    insert(AnalysisResult).values(
+                        sha256=digests[2], model_version='v3', alt_text='a dog', objects='[]', inference_time=1.0
+                    )
+                )
+                return super().analyze_batch(images)
+
+        results = analyze_uncached(RacingAnalyzer(), paths[1:], digests[1:], 'v3')
+        self.assertEqual([result.alt_text for result in results], ['a cat', 'a dog'])
+        db.session.commit()
+        self.assertEqual(db.session.scalar(select(db.func.count(AnalysisResult.id))), 5)
+
+        class FailingAnalyzer(Analyzer):
+            def analyze_batch(self, images, batch_size=None, profile=None, backlog=0):
+                results = super().analyze_batch(images)
+                results[0].update(alt_text=MLImageAnalyzer.FALLBACK_CAPTION, objects=[], error='OSError: no weights')
+                return results
+
+        # the failed image is left to the next attempt instead of caching its fallback
+        results = analyze_uncached(FailingAnalyzer(), paths[1:], digests[1:], 'v4')
+        self.assertIsNone(results[0])
+        self.assertEqual(results[1].alt_text, 'a cat')
+        db.session.commit()
+        stored = db.session.scalars(select(AnalysisResult.sha256).filter_by(model_version='v4')).all()
+        self.assertEqual(stored, [digests[2]])
+
+    def test_startup_skips_ml_libraries(self):
+        # torch and transformers are only imported by the processes running the models
+        code = (
+            "import sys; from moments import create_app; create_app('testing'); "
+            'from moments.ml_services import MLImageAnalyzer; MLImageAnalyzer(); '
+            "print(sorted(name for name in ('torch', 'transformers') if name in sys.modules))"
+        )
+        root = Path(__file__).resolve().parent.parent
+        output = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True)
+        self.assertEqual(output.stdout.strip(), '[]')
@@ -0,0 +1,74 @@
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+from PIL import Image
+
+from moments.ml_server import create_server
+from moments.ml_services import MLImageAnalyzer
+from tests import BaseTestCase
+
+
+class MLServerTestCase(BaseTestCase):
+    def test_ml_server(self):
+        class Analyzer:
+            batches = []
+            profiles = []
+
+            def analyze_batch(self, images, batch_size=None, profile=None, backlog=0):
+                self.batches.append(images)
+                self.profiles.append((profile, backlog))
+                return [{'alt_text': f'image {i}', 'objects': [], 'keywords': []} for i in range(len(images))]
+
+        upload_path = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, upload_path)
+        server = create_server(Analyzer(), port=0, upload_path=upload_path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            client = MLImageAnalyzer(server_url=f'http://127.0.0.1:{server.server_port}')
+            image_path = str(upload_path / 'test.jpg')
+            results = client.analyze_batch([image_path, Image.new('RGB', (10, 10))], profile='fast', backlog=3)
+            self.assertEqual([result['alt_text'] for result in results], ['image 0', 'image 1'])
+            self.assertEqual(len(Analyzer.batches), 1)
+            self.assertTrue(Analyzer.batches[0][0].endswith('test.jpg'))
+            self.assertIsInstance(Analyzer.batches[0][1], Image.Image)
+            self.assertEqual(Analyzer.profiles, [('fast', 3)])
+
+            # only the uploads are read from the disk
+            for path in [str(upload_path / '..' / 'test.jpg'), '/etc/passwd']:
+                response = requests.post(f'{client.server_url}/analyze', json={'images': [{'path': path}]})
+                self.assertEqual(response.status_code, 400)
+            self.assertEqual(len(Analyzer.batches), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # nothing listens anymore, the caller falls back to the in-process models
+        self.assertIsNone(client._analyze_remote(['test.jpg'], None))
+
+    def test_ml_server_readiness(self):
+        loaded = threading.Event()
+
+        class Analyzer:
+            def warm_up(self):
+                loaded.wait(5)
+
+        server = create_server(Analyzer(), port=0, warm_up=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}/health'
+        try:
+            response = requests.get(url)
+            self.assertEqual((response.status_code, response.json()['status']), (503, 'loading'))
+            loaded.set()
+            for _ in range(50):
+                if server.status == 'ready':
+                    break
+                time.sleep(0.01)
+            response = requests.get(url)
+            self.assertEqual((response.status_code, response.json()['status']), (200, 'ready'))
+        finally:
+            server.shutdown()
+            server.server_close()
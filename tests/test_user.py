@@ -1,7 +1,15 @@
+import base64
 import io
+import json
+import re
+from datetime import datetime, timedelta
+
+from flask_login import login_user
+from sqlalchemy import event, select
 
 from moments.core.extensions import db
 from moments.models import Photo, User
+from moments.relations import get_relations
 from moments.settings import Operations
 from moments.utils import generate_token
 from tests import BaseTestCase
@@ -19,6 +27,44 @@ class UserTestCase(BaseTestCase):
         self.assertIn('Locked User', data)
         self.assertIn('Your account is locked.', data)
 
+    def test_index_page_cursor_pagination(self):
+        self.app.config['MOMENTS_PHOTO_PER_PAGE'] = 2
+        user = db.session.get(User, 2)
+        now = datetime.now()
+        for i in range(3, 6):
+            photo = Photo(filename='test.jpg', filename_s=f'cursor{i}_s.jpg', filename_m='test_m.jpg', author=user)
+            photo.created_at = now + timedelta(seconds=i)
+            db.session.add(photo)
+        db.session.commit()
+
+        response = self.client.get('/user/normal')
+        data = response.get_data(as_text=True)
+        self.assertIn('cursor5_s.jpg', data)
+        self.assertIn('cursor4_s.jpg', data)
+        self.assertNotIn('cursor3_s.jpg', data)
+        next_url = re.search(r'href="(/user/normal\?cursor=[^"]+)">Next', data).group(1)
+
+        response = self.client.get(next_url)
+        data = response.get_data(as_text=True)
+        self.assertIn('cursor3_s.jpg', data)
+        self.assertIn('test_s2.jpg', data)
+        self.assertNotIn('cursor4_s.jpg', data)
+        prev_url = re.search(r'href="(/user/normal\?cursor=[^"]+)">&laquo; Previous', data).group(1)
+
+        response = self.client.get(prev_url)
+        data = response.get_data(as_text=True)
+        self.assertIn('cursor5_s.jpg', data)
+        self.assertIn('cursor4_s.jpg', data)
+        self.assertNotIn('cursor3_s.jpg', data)
+
+        response = self.client.get('/user/normal?cursor=invalid')
+        self.assertEqual(response.status_code, 400)
+        # well-formed but tampered values of the wrong type
+        for values in (['2020-01-01T00:00:00', {'a': 1}], [{'a': 1}, 1], ['2020-01-01T00:00:00', True]):
+            cursor = base64.urlsafe_b64encode(json.dumps(['next', values]).encode()).decode()
+            response = self.client.get(f'/user/normal?cursor={cursor}')
+            self.assertEqual(response.status_code, 400)
+
     def test_show_collections(self):
         response = self.client.get('/user/normal/collections')
         data = response.get_data(as_text=True)
@@ -89,6 +135,45 @@ class UserTestCase(BaseTestCase):
         self.assertIn('Admin', data)
         self.assertNotIn('No followers.', data)
 
+    def test_show_followers_relations(self):
+        user = db.session.get(User, 2)
+        admin = db.session.get(User, 1)
+        locked = db.session.get(User, 4)
+        admin.follow(user)
+        locked.follow(user)
+        user.follow(admin)
+
+        self.login()
+        response = self.client.get('/user/normal/followers')
+        data = response.get_data(as_text=True)
+        self.assertIn('Follow each other', data)
+        self.assertIn('Follows you', data)
+        self.assertEqual(data.count('Unfollow'), 1)
+
+    def test_relation_resolver(self):
+        user = db.session.get(User, 2)
+        users = db.session.scalars(select(User)).all()
+        user.follow(users[0])
+        users[2].follow(user)
+
+        users = db.session.scalars(select(User)).all()  # reload the instances expired by the commits
+        statements = []
+        with self.app.test_request_context():
+            login_user(user)
+            relations = get_relations()
+
+            def record(*args):
+                statements.append(args[2])
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            self.addCleanup(event.remove, db.engine, 'before_cursor_execute', record)
+            relations.load_users(users)
+            self.assertTrue(relations.is_following(users[0]))
+            self.assertFalse(relations.is_following(users[2]))
+            self.assertTrue(relations.is_followed_by(users[2]))
+            self.assertFalse(relations.is_followed_by(users[3]))
+        self.assertEqual(len(statements), 1)
+
     def test_show_following(self):
         response = self.client.get('/user/normal/following')
         data = response.get_data(as_text=True)